@@ -0,0 +1,273 @@
+import asyncio
+from collections import deque
+
+from protocol import (COMPRESSED_HANDSHAKE, EVENT, HANDSHAKE, HANDSHAKE_TIMEOUT, HANDSHAKES, RECV_SIZE, REPLY,
+                      REQUEST, FrameDecoder, ZlibCodec, encode_frame)
+
+# Chatroom messages kept for the event iterator before the oldest are dropped
+DEFAULT_MAX_EVENTS = 10000
+# Chatrooms asked for at once when paging through the listing
+DEFAULT_PAGE = 500
+
+
+def parse_listing(reply, counts=False):
+    # A chatroom listing has one chatroom_name|member1,member2 line per chatroom,
+    # or chatroom_name|member count
+    rooms = {}
+    for line in reply.splitlines():
+        chatroom_name, _, members = line.partition("|")
+        if counts:
+            rooms[chatroom_name] = int(members or 0)
+        else:
+            rooms[chatroom_name] = members.split(",") if members else []
+    return rooms
+
+
+class CommandError(Exception):
+    # The server answered a command with something other than SUCCESS
+    def __init__(self, reply):
+        super().__init__(reply)
+        self.reply = reply
+
+
+class AsyncChatClient:
+    # Chat client for asyncio programs such as bots and load tools. Commands can
+    # be sent from many tasks at once: each gets a request id and waits for the
+    # reply with that id, while one reader task takes everything off the socket.
+    # Chatroom messages pushed by the server go to the on_event callback, or are
+    # kept for iterating with `async for event in client`. Frames are compressed
+    # when compress is set and the server agrees to it.
+    def __init__(self, host='127.0.0.1', port=5000, on_event=None, max_events=DEFAULT_MAX_EVENTS, compress=True):
+        self.host = host
+        self.port = port
+        self.compress = compress
+        self.codec = None
+        self.on_event = on_event
+        self.username = None
+        self.chatroom = None
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.request_id = 0
+        # Request id -> future of the reply
+        self.pending = {}
+        # Chatroom messages not iterated yet, and a waiter for the next one
+        self.events = deque(maxlen=max_events)
+        self.event_ready = asyncio.Event()
+        self.dropped_events = 0
+        self.closed = False
+        # Chatroom name -> sequence number of the last message seen there
+        self.cursors = {}
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # Replies can only be told apart in the framed protocol
+        self.writer.write(COMPRESSED_HANDSHAKE if self.compress else HANDSHAKE)
+        try:
+            reply = await asyncio.wait_for(self.reader.readexactly(len(HANDSHAKE)), HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            reply = b""
+        if reply not in HANDSHAKES:
+            self.writer.close()
+            raise ConnectionError("Server does not support the framed protocol")
+        if reply == COMPRESSED_HANDSHAKE:
+            self.codec = ZlibCodec()
+        self.reader_task = asyncio.ensure_future(self.read_frames())
+        return self
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def read_frames(self):
+        # The only reader of the socket, hands out replies and events
+        decoder = FrameDecoder(self.codec)
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for kind, request_id, fields in decoder.feed(data):
+                    if kind == REPLY:
+                        future = self.pending.pop(request_id, None)
+                        if future is not None and not future.done():
+                            future.set_result(fields)
+                    elif kind == EVENT:
+                        self.deliver(fields)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.shut_down(ConnectionError("Connection closed by server"))
+
+    def deliver(self, fields):
+        # The server checks that the client is still there, request id 0 asks for no reply
+        if fields[0] == "PING":
+            self.send_frame(["PONG"], 0)
+            return
+        if fields[0] == "MESSAGE" and len(fields) > 5 and fields[5]:
+            self.cursors[fields[4]] = fields[5]
+        if self.on_event is not None:
+            self.on_event(fields)
+            return
+        if len(self.events) == self.events.maxlen:
+            self.dropped_events += 1
+        self.events.append(fields)
+        self.event_ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # The next chatroom message, as its list of fields
+        while not self.events:
+            if self.closed:
+                raise StopAsyncIteration
+            self.event_ready.clear()
+            await self.event_ready.wait()
+        return self.events.popleft()
+
+    async def request(self, *fields):
+        # Send a command and wait for its reply, other commands may be in flight meanwhile
+        return (await self.request_fields(*fields))[0]
+
+    async def request_fields(self, *fields):
+        # Like request, but returns every field of the reply
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        # Request id 0 is left for frames that want no reply
+        self.request_id = self.request_id % 0xFFFFFFFF + 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.request_id] = future
+        self.send_frame(fields, self.request_id)
+        await self.writer.drain()
+        return await future
+
+    def send_frame(self, fields, request_id):
+        frame = encode_frame(REQUEST, list(fields), request_id)
+        self.writer.write(self.codec.compress_frame(frame) if self.codec is not None else frame)
+
+    async def command(self, *fields):
+        # Like request, but raises CommandError unless the reply is SUCCESS.
+        # Returns what follows SUCCESS| in the reply, if anything.
+        reply = await self.request(*fields)
+        if not reply.startswith("SUCCESS"):
+            raise CommandError(reply)
+        return reply[len("SUCCESS|"):] or None
+
+    async def register(self, username, password):
+        await self.command("REGISTER", username, password)
+        self.username = username
+
+    async def login(self, username, password):
+        # Returns the chatroom the user is in, if any
+        cursor = [self.cursors[self.chatroom]] if self.chatroom in self.cursors else []
+        self.chatroom = await self.command("LOGIN", username, password, *cursor)
+        self.username = username
+        return self.chatroom
+
+    async def logout(self):
+        await self.command("LOGOUT", self.username)
+        self.chatroom = None
+
+    async def create_chatroom(self, chatroom_name):
+        await self.command("CREATE_CHATROOM", self.username, chatroom_name)
+        self.chatroom = chatroom_name
+
+    async def join_chatroom(self, chatroom_name):
+        cursor = [self.cursors[chatroom_name]] if chatroom_name in self.cursors else []
+        await self.command("JOIN_CHATROOM", self.username, chatroom_name, *cursor)
+        self.chatroom = chatroom_name
+
+    async def leave_chatroom(self):
+        await self.command("LEAVE_CHATROOM", self.username)
+        self.chatroom = None
+
+    async def view_chatrooms(self):
+        # Chatroom name -> list of members
+        return parse_listing(await self.request("VIEW_CHATROOMS"))
+
+    async def chatroom_page(self, prefix="", after="", limit=DEFAULT_PAGE, counts=False):
+        # A page of the chatrooms whose name starts with prefix. Returns the
+        # directory version, chatroom name -> members (or member count with
+        # counts) and the cursor of the next page, None after the last one.
+        reply = await self.request("VIEW_CHATROOMS", f"prefix={prefix}", f"after={after}", f"limit={limit}",
+                                   f"counts={int(counts)}")
+        if not reply.startswith("SUCCESS"):
+            raise CommandError(reply)
+        header, _, listing = reply.partition("\n")
+        _, version, cursor = header.split("|", 2)
+        return version, parse_listing(listing, counts), cursor or None
+
+    async def chatroom_changes(self, since, prefix="", counts=False):
+        # The chatrooms changed since a directory version. Returns the new
+        # version, the changed chatrooms and whether the server sent all
+        # chatrooms instead because the version was too old.
+        reply = await self.request("VIEW_CHATROOMS", f"since={since}", f"prefix={prefix}", f"counts={int(counts)}")
+        if not reply.startswith("SUCCESS"):
+            raise CommandError(reply)
+        header, _, listing = reply.partition("\n")
+        _, version, kind = header.split("|", 2)
+        return version, parse_listing(listing, counts), kind == "FULL"
+
+    async def send_message(self, message):
+        await self.command("MESSAGE", self.username, message)
+
+    async def direct_message(self, recipient, message):
+        # Returns to how many connections of the recipient it went, 0 when the
+        # server keeps it until they log in
+        return int(await self.command("DIRECT_MESSAGE", self.username, recipient, message))
+
+    async def batch(self, *commands):
+        # Run several commands, each a list of fields, in one round trip.
+        # Returns their replies in order.
+        fields = ["BATCH"]
+        for command in commands:
+            fields += [len(command), *command]
+        reply, *replies = await self.request_fields(*fields)
+        if not reply.startswith("SUCCESS"):
+            raise CommandError(reply)
+        return replies
+
+    async def post_to_rooms(self, message, chatroom_names):
+        # Post one message to several chatrooms, returns to how many it went
+        return int(await self.command("MULTI_MESSAGE", self.username, message, *chatroom_names))
+
+    async def room_members(self, chatroom_names):
+        # Chatroom name -> list of members, for the given chatrooms that exist
+        return parse_listing(await self.request("ROOM_MEMBERS", *chatroom_names))
+
+    async def history(self, limit=None):
+        # Asks for the latest messages of the chatroom, they arrive as events.
+        # Returns how many there are.
+        count = await self.command("HISTORY", self.username, "", *([limit] if limit else []))
+        return int(count)
+
+    async def current_info(self):
+        self.chatroom = await self.command("CURRENT_INFO", self.username)
+        return self.chatroom
+
+    def shut_down(self, error):
+        # Fail the commands still waiting and end the event iterator
+        self.closed = True
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.event_ready.set()
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+        self.shut_down(ConnectionError("Connection closed"))
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
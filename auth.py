@@ -0,0 +1,83 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# scrypt cost, about 16 MB of memory and a few tens of milliseconds per hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+# Used when the OpenSSL build has no scrypt
+PBKDF2_ITERATIONS = 200000
+SALT_SIZE = 16
+
+# Threads that hash passwords, hashlib releases the GIL while hashing
+HASH_WORKERS = 4
+# How long a verified password is remembered for reconnects
+CACHE_TTL = 600
+# Most users remembered at once
+CACHE_SIZE = 100000
+
+
+def hash_password(password, salt=None):
+    # A stored credential: the KDF, its parameters, the salt and the derived key
+    salt = os.urandom(SALT_SIZE) if salt is None else salt
+    if hasattr(hashlib, "scrypt"):
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+
+def check_password(credential, password):
+    # Derive the key again with the stored parameters and compare in constant time
+    kdf, *params = credential.split("$")
+    if kdf == "scrypt":
+        n, r, p, salt, digest = params
+        derived = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    elif kdf == "pbkdf2_sha256":
+        iterations, salt, digest = params
+        derived = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+    else:
+        return False
+    return hmac.compare_digest(derived, bytes.fromhex(digest))
+
+
+class PasswordHasher:
+    # Runs the slow KDF on a bounded pool of threads, so a burst of logins uses at
+    # most that many cores and the threads handling messages keep running.
+    # Passwords that were verified recently are remembered, keyed with a secret
+    # that only lives in this process, so a reconnect skips the KDF.
+    def __init__(self, workers=HASH_WORKERS, cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache_secret = os.urandom(32)
+        self.cache_lock = threading.Lock()
+        # Username -> (credential, keyed digest of the password, expiry)
+        self.cache = {}
+
+    def hash(self, password):
+        return self.pool.submit(hash_password, password).result()
+
+    def verify(self, username, credential, password):
+        if credential is None:
+            return False
+        key = hmac.new(self.cache_secret, password.encode(), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self.cache_lock:
+            entry = self.cache.get(username)
+        # A changed credential invalidates the entry
+        if entry is not None and entry[0] is credential and entry[2] > now and hmac.compare_digest(entry[1], key):
+            return True
+        if not self.pool.submit(check_password, credential, password).result():
+            return False
+        with self.cache_lock:
+            self.cache.pop(username, None)
+            if len(self.cache) >= self.cache_size:
+                # Forget the entry that was added first
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[username] = (credential, key, now + self.cache_ttl)
+        return True
@@ -0,0 +1,83 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection import Connection
+from protocol import EVENT, encode_frame, format_event
+from server import ChatServer
+
+
+class NullConnection(Connection):
+    # Goes through the outbound queue like a real connection, then throws the data away
+    def __init__(self, framed):
+        super().__init__()
+        self.framed = framed
+        self.bytes_sent = 0
+
+    def sendall(self, data):
+        self.push(data)
+        for data in self.take():
+            self.bytes_sent += len(data)
+
+    def close(self):
+        self.closed = True
+
+
+def build_room(members):
+    server = ChatServer('127.0.0.1', 0)
+    for i in range(members):
+        username = f"user{i}"
+        server.state.add_user(username, "password")
+        if i == 0:
+            server.state.create_room(username, "bench")
+        else:
+            server.state.join_room(username, "bench")
+        # Half of the members use the framed protocol, the other half the text protocol
+        server.state.add_connection(username, NullConnection(framed=i % 2 == 0))
+    return server
+
+
+def per_recipient_broadcast(server, username, message):
+    # The previous fan-out: format and encode the message again for every connection
+    for client in server.state.members(server.state.room_of(username)):
+        for conn in server.state.connections(client):
+            fields = ["MESSAGE", datetime.now().strftime('%Y-%m-%d %H:%M:%S'), username, message]
+            if conn.framed:
+                conn.sendall(encode_frame(EVENT, fields))
+            else:
+                conn.sendall(format_event(fields).encode())
+
+
+def measure(send, server, messages):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for i in range(messages):
+            send(server, "user0", f"benchmark message number {i}")
+        return (time.perf_counter() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of one chatroom broadcast by room size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'members':>8} {'encode once':>14} {'per recipient':>14} {'speedup':>8}")
+    for members in args.sizes:
+        server = build_room(members)
+        # Fewer messages for large rooms so every size takes about as long
+        messages = max(5, args.messages * 10 // max(members, 10))
+        once = measure(ChatServer.send_message, server, messages)
+        each = measure(per_recipient_broadcast, server, messages)
+        server.server_sock.close()
+        print(f"{members:>8} {once * 1e6:>11.1f} us {each * 1e6:>11.1f} us {each / once:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from async_client import AsyncChatClient
+from load_gen import git_revision, process_rss
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PASSWORD = "cluster-password"
+ROOM = "bench"
+
+
+def wait_for_port(host, port, process):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process on port {port} exited")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listens on port {port}")
+
+
+def start_cluster(args, nodes):
+    # The relay and the nodes, each in its own process. Nothing is kept on disk
+    # or replayed on join and no rate limit gets in the way.
+    processes = [subprocess.Popen([sys.executable, os.path.join(ROOT, "relay.py"), "--host", args.host,
+                                   "--port", str(args.relay_port), "--log-level", "WARNING"], cwd=ROOT)]
+    wait_for_port(args.host, args.relay_port, processes[0])
+    for node in range(nodes):
+        port = args.port + node
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "server.py"), "--host", args.host, "--port", str(port),
+             "--mode", args.mode, "--relay", f"{args.host}:{args.relay_port}", "--node-id", f"node{node}",
+             "--state-dir", "", "--log-dir", "", "--history", "0", "--idle-timeout", "0",
+             "--connection-limit", "0", "--user-limit", "0", "--room-limit", "0", "--log-level", "WARNING"],
+            cwd=ROOT, stdout=subprocess.DEVNULL))
+        wait_for_port(args.host, port, processes[-1])
+    return processes
+
+
+async def wait_for(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Timed out waiting for {what}")
+        await asyncio.sleep(0.1)
+
+
+async def run(args, nodes, processes):
+    ports = [args.port + node for node in range(nodes)]
+    usernames = [f"user{i}" for i in range(args.users)]
+    sender = await AsyncChatClient(args.host, ports[0]).connect()
+    await sender.register("sender", PASSWORD)
+    await sender.create_chatroom(ROOM)
+
+    async def room_everywhere():
+        for port in ports:
+            async with AsyncChatClient(args.host, port) as client:
+                if ROOM not in await client.room_members([ROOM]):
+                    return False
+        return True
+    await wait_for(room_everywhere, 30, "every node to see the chatroom")
+
+    # Every node gets the same number of connections. The first connection of
+    # a user registers it and joins the chatroom, the others log in. None of
+    # them may close before the end: a user whose last connection is gone is
+    # logged out, which takes them out of the chatroom.
+    received = [0] * (nodes * args.connections)
+    clients = []
+
+    def counter(index):
+        def count(fields):
+            if fields[0] == "MESSAGE":
+                received[index] += 1
+        return count
+    setup_start = time.monotonic()
+    for index in range(nodes * args.connections):
+        client = await AsyncChatClient(args.host, ports[index % nodes], on_event=counter(index),
+                                       compress=False).connect()
+        if index < args.users:
+            await client.register(usernames[index], PASSWORD)
+            await client.join_chatroom(ROOM)
+        else:
+            await client.login(usernames[index % args.users], PASSWORD)
+        clients.append(client)
+
+    async def room_complete():
+        async with AsyncChatClient(args.host, ports[-1]) as client:
+            members = await client.room_members([ROOM])
+        return len(members.get(ROOM, ())) == min(args.users, len(received)) + 1
+    await wait_for(room_complete, 30, "every node to see every member")
+    setup_time = time.monotonic() - setup_start
+
+    # Every message goes to every connection, wherever it is
+    expected = len(received) * args.messages
+    start = time.monotonic()
+    for i in range(args.messages):
+        await sender.send_message(f"cluster benchmark message {i}")
+
+    async def all_delivered():
+        return sum(received) >= expected
+    try:
+        await wait_for(all_delivered, args.timeout, "the messages")
+    except RuntimeError:
+        pass
+    elapsed = time.monotonic() - start
+    # Memory of each node with its connections, the relay is the first process
+    node_rss = [process_rss(process.pid) for process in processes[1:]]
+    relay_rss = process_rss(processes[0].pid)
+    for client in clients + [sender]:
+        await client.close()
+    return {
+        "nodes": nodes,
+        "connections": len(received),
+        "connections_per_node": args.connections,
+        "setup_seconds": round(setup_time, 3),
+        "messages": args.messages,
+        "deliveries": sum(received),
+        "expected_deliveries": expected,
+        "seconds": round(elapsed, 3),
+        "deliveries_per_second": round(sum(received) / elapsed, 1),
+        "node_rss_bytes": node_rss,
+        "relay_rss_bytes": relay_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs clusters of chat servers on this machine and posts to a chatroom whose members are "
+                    "connected to every node, prints a JSON report per cluster size")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5200, help="port of the first node, the others follow it")
+    parser.add_argument("--relay-port", type=int, default=6200)
+    parser.add_argument("--mode", choices=["threaded", "async"], default="async")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--connections", type=int, default=500, help="client connections per node")
+    parser.add_argument("--users", type=int, default=50, help="users the connections log in as")
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the messages")
+    args = parser.parse_args()
+
+    # Every connection holds a socket
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    reports = []
+    for nodes in args.nodes:
+        processes = start_cluster(args, nodes)
+        try:
+            report = asyncio.run(run(args, nodes, processes))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+        reports.append(report)
+        print(f"{nodes} nodes: {report['deliveries']}/{report['expected_deliveries']} deliveries to "
+              f"{report['connections']} connections in {report['seconds']} s", file=sys.stderr)
+    json.dump({"revision": git_revision(), "config": vars(args), "clusters": reports}, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connection import Connection
+from server import ChatServer
+
+# Order of the if/elif chain the command registry replaced
+CHAIN = ("REGISTER", "LOGIN", "LOGOUT", "CREATE_CHATROOM", "JOIN_CHATROOM", "LEAVE_CHATROOM", "VIEW_CHATROOMS",
+         "MESSAGE", "MULTI_MESSAGE", "ROOM_MEMBERS", "BATCH", "HISTORY", "PING", "PONG", "CURRENT_INFO")
+# Commands that are cheap to handle, so what is measured is mostly getting to the handler
+COMMANDS = (["PONG"], ["PING"], ["CURRENT_INFO", "user0"], ["ROOM_MEMBERS", "bench"])
+
+
+class NullConnection(Connection):
+    # Replies are encoded as usual and then thrown away
+    def __init__(self):
+        super().__init__()
+        self.framed = True
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def build_chain():
+    # An if/elif chain over CHAIN like the one of the old dispatcher
+    lines = ["def chain(command):"]
+    for index, name in enumerate(CHAIN):
+        lines.append(f"    {'if' if index == 0 else 'elif'} command == {name!r}:")
+        lines.append(f"        return {index}")
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["chain"]
+
+
+def measure(call, iterations):
+    # Nanoseconds per call, the loop itself taken off
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        call()
+    elapsed = time.perf_counter_ns() - start
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        pass
+    return (elapsed - (time.perf_counter_ns() - start)) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overhead of dispatching a command to its handler")
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    # No rate limit may get in the way, but the checks still run
+    server = ChatServer('127.0.0.1', 0, connection_limit=(1e12, 1e12))
+    server.state.add_user("user0", "password")
+    server.state.create_room("user0", "bench")
+    conn = NullConnection()
+    chain = build_chain()
+    commands = server.commands
+
+    print(f"{'command':>14} {'if/elif':>9} {'lookup':>9} {'handler':>9} {'dispatch':>9} {'handle':>9} {'overhead':>9}")
+    for data in COMMANDS:
+        name = data[0]
+        command = commands.get(name)
+        arguments = command.arguments(data)
+        chained = measure(lambda: chain(name), args.iterations)
+        lookup = measure(lambda: commands.get(name), args.iterations)
+        handler = measure(lambda: command.handler(conn, 0, *arguments), args.iterations)
+        dispatch = measure(lambda: commands.dispatch(conn, data), args.iterations)
+        # Rate limits and the latency histogram included
+        handle = measure(lambda: server.handle_command(conn, data), args.iterations)
+        print(f"{name:>14} {chained:>6.0f} ns {lookup:>6.0f} ns {handler:>6.0f} ns {dispatch:>6.0f} ns "
+              f"{handle:>6.0f} ns {handle - handler:>6.0f} ns")
+    server.server_sock.close()
+
+
+if __name__ == '__main__':
+    main()
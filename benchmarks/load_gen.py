@@ -0,0 +1,318 @@
+import argparse
+import glob
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import ChatClient
+from protocol import EVENT
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PASSWORD = "load-password"
+
+
+class LoadClient(ChatClient):
+    # A ChatClient without the menu and prints. Every chatroom message it
+    # receives is timed against the send time the sender put in front of it.
+    def __init__(self, host, port, stats, compress=True):
+        # Pings are answered while pumping, no heartbeat thread is needed
+        super().__init__(host, port, compress=compress, heartbeat=False)
+        self.stats = stats
+        # Messages sent before the last join are replays, they are not timed
+        self.joined_at = 0
+
+    def note_event(self, fields):
+        super().note_event(fields)
+        if fields[0] != "MESSAGE":
+            return
+        stamp = fields[3].split(" ", 1)[0]
+        if stamp.isdigit() and int(stamp) >= self.joined_at:
+            self.stats.latencies.append(time.monotonic_ns() - int(stamp))
+
+    def call(self, *fields):
+        # Send a command and wait for its reply, timing the chatroom messages that arrive meanwhile
+        self.stats.commands[fields[0]] = self.stats.commands.get(fields[0], 0) + 1
+        self.send_command(*fields)
+        reply = self.receive_reply()
+        self.events.clear()
+        return reply
+
+    def pump(self, seconds):
+        # Receive chatroom messages for a while
+        deadline = time.monotonic() + seconds
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.socket.settimeout(remaining)
+                kind, request_id, fields = self.receive_frame()
+                if kind == EVENT:
+                    self.note_event(fields)
+        except socket.timeout:
+            pass
+        finally:
+            self.socket.settimeout(None)
+
+
+class UserStats:
+    # What one simulated user saw, merged into the report at the end
+    def __init__(self):
+        self.latencies = []
+        self.commands = {}
+        self.sent = 0
+        self.errors = 0
+        self.failed = None
+
+
+class LoadGenerator:
+    # Simulates users that register, join chatrooms and then send messages,
+    # with some of them switching chatrooms or logging out and back in
+    def __init__(self, args):
+        self.args = args
+        self.ready = 0
+        self.ready_lock = threading.Lock()
+        self.go = threading.Event()
+        self.stop = threading.Event()
+        self.stats = [UserStats() for _ in range(args.users)]
+
+    def connect(self, stats):
+        client = LoadClient(self.args.host, self.args.port, stats, not self.args.no_compression)
+        client.connect()
+        if not client.framed:
+            raise ConnectionError("Server does not speak the framed protocol")
+        return client
+
+    def join(self, client, username, chatroom_name):
+        # Join a chatroom, creating it if nobody has yet
+        client.joined_at = time.monotonic_ns()
+        while True:
+            reply = client.call("JOIN_CHATROOM", username, chatroom_name)
+            if reply == "Chatroom does not exist":
+                reply = client.call("CREATE_CHATROOM", username, chatroom_name)
+                if reply == "Chatroom already exists":
+                    continue
+            if reply != "SUCCESS":
+                client.stats.errors += 1
+            return reply
+
+    def run_user(self, index):
+        args = self.args
+        stats = self.stats[index]
+        rng = random.Random(args.seed + index)
+        username = f"{args.prefix}{index}"
+        chatroom_name = f"{args.prefix}room{index % args.rooms}"
+        client = None
+        try:
+            client = self.connect(stats)
+            if client.call("REGISTER", username, PASSWORD) != "SUCCESS":
+                client.call("LOGIN", username, PASSWORD)
+            self.join(client, username, chatroom_name)
+            with self.ready_lock:
+                self.ready += 1
+            self.go.wait()
+
+            payload = "x" * args.size
+            while not self.stop.is_set():
+                action = rng.random()
+                if action < args.churn / 2:
+                    # Move to another chatroom
+                    chatroom_name = f"{args.prefix}room{rng.randrange(args.rooms)}"
+                    self.join(client, username, chatroom_name)
+                elif action < args.churn:
+                    # Log out and come back on a new connection
+                    client.call("LOGOUT", username)
+                    client.socket.close()
+                    client = self.connect(stats)
+                    if not client.call("LOGIN", username, PASSWORD).startswith("SUCCESS"):
+                        stats.errors += 1
+                    self.join(client, username, chatroom_name)
+                elif client.call("MESSAGE", username, f"{time.monotonic_ns()} {payload}") == "SUCCESS":
+                    stats.sent += 1
+                else:
+                    stats.errors += 1
+                client.pump(rng.expovariate(1 / args.think) if args.think > 0 else 0)
+        except Exception as e:
+            stats.failed = repr(e)
+            with self.ready_lock:
+                self.ready += 1
+        finally:
+            if client is not None:
+                client.socket.close()
+
+    def run(self, server_pid=None):
+        args = self.args
+        # Small stacks, there is one thread per simulated user
+        threading.stack_size(256 * 1024)
+        threads = [threading.Thread(target=self.run_user, args=(i,), daemon=True) for i in range(args.users)]
+        setup_start = time.monotonic()
+        for thread in threads:
+            thread.start()
+            # Do not overrun the listen backlog
+            time.sleep(args.ramp / args.users)
+        while self.ready < args.users and time.monotonic() - setup_start < args.setup_timeout:
+            time.sleep(0.05)
+        setup_time = time.monotonic() - setup_start
+
+        rss_start = process_rss(server_pid)
+        rss_peak = rss_start
+        self.go.set()
+        start = time.monotonic()
+        while time.monotonic() - start < args.duration:
+            time.sleep(min(0.5, args.duration))
+            rss = process_rss(server_pid)
+            if rss is not None and (rss_peak is None or rss > rss_peak):
+                rss_peak = rss
+        self.stop.set()
+        elapsed = time.monotonic() - start
+        for thread in threads:
+            thread.join(args.think + 5)
+        return self.report(setup_time, elapsed, rss_start, rss_peak, process_rss(server_pid))
+
+    def report(self, setup_time, elapsed, rss_start, rss_peak, rss_end):
+        latencies = sorted(latency for stats in self.stats for latency in stats.latencies)
+        commands = {}
+        for stats in self.stats:
+            for command, count in stats.commands.items():
+                commands[command] = commands.get(command, 0) + count
+        sent = sum(stats.sent for stats in self.stats)
+        failures = [stats.failed for stats in self.stats if stats.failed]
+        return {
+            "revision": git_revision(),
+            "config": vars(self.args),
+            "setup_seconds": round(setup_time, 3),
+            "duration_seconds": round(elapsed, 3),
+            "messages_sent": sent,
+            "messages_per_second": round(sent / elapsed, 1),
+            "deliveries": len(latencies),
+            "deliveries_per_second": round(len(latencies) / elapsed, 1),
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p99": percentile(latencies, 0.99),
+                "p999": percentile(latencies, 0.999),
+                "max": percentile(latencies, 1.0),
+            },
+            "commands": commands,
+            "errors": sum(stats.errors for stats in self.stats),
+            "failed_users": len(failures),
+            "first_failure": failures[0] if failures else None,
+            "server_rss_bytes": {"start": rss_start, "peak": rss_peak, "end": rss_end},
+        }
+
+
+def percentile(values, q):
+    # Nearest rank percentile of sorted nanoseconds, in milliseconds
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(q * len(values)))] / 1e6, 3)
+
+
+def process_rss(pid):
+    # Resident memory of a process and all its children, from /proc
+    if pid is None or not os.path.exists(f"/proc/{pid}"):
+        return None
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+        for path in glob.glob(f"/proc/{pid}/task/*/children"):
+            with open(path) as f:
+                for child in f.read().split():
+                    total += process_rss(int(child)) or 0
+    except OSError:
+        pass
+    return total
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args, server_args):
+    # Run the server in its own process and wait until it accepts connections.
+    # Nothing is replayed on join, so replays do not mix with the timed messages,
+    # and only warnings are logged.
+    command = [sys.executable, os.path.join(ROOT, "server.py"), "--host", args.host, "--port", str(args.port),
+               "--history", "0", "--log-level", "WARNING", *server_args]
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load generator for the chat server, prints a JSON report. "
+                    "Arguments after -- are passed to server.py.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--external", action="store_true",
+                        help="use a server that is already running instead of starting one")
+    parser.add_argument("--server-pid", type=int, default=None,
+                        help="process of the external server, for its memory use")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measured load")
+    parser.add_argument("--think", type=float, default=0.05, help="mean seconds between the actions of a user")
+    parser.add_argument("--churn", type=float, default=0.02,
+                        help="share of actions that switch chatrooms or log out and back in")
+    parser.add_argument("--size", type=int, default=64, help="bytes of text per message")
+    parser.add_argument("--no-compression", action="store_true", help="do not ask the server for compression")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which the users connect")
+    parser.add_argument("--setup-timeout", type=float, default=300)
+    parser.add_argument("--prefix", default="load", help="prefix of the user and chatroom names")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    argv = sys.argv[1:]
+    server_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    # Every simulated user holds a socket
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = None if args.external else start_server(args, server_args)
+    try:
+        report = LoadGenerator(args).run(args.server_pid if args.external else server.pid)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    report["server_args"] = server_args
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
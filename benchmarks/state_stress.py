@@ -0,0 +1,95 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state import ChatState
+
+
+def worker(state, worker_id, rooms, users, operations, errors):
+    rng = random.Random(worker_id)
+    # Every worker owns its users, but all workers share the rooms
+    usernames = [f"user{worker_id}_{i}" for i in range(users)]
+    for username in usernames:
+        state.add_user(username, "password")
+        state.add_connection(username, object())
+    try:
+        for _ in range(operations):
+            username = rng.choice(usernames)
+            action = rng.random()
+            if action < 0.4:
+                state.join_room(username, rng.choice(rooms))
+            elif action < 0.6:
+                state.leave_room(username)
+            elif action < 0.9:
+                # What a broadcast does: snapshot the members, then read their connections
+                for member in state.members(rng.choice(rooms)):
+                    state.connections(member)
+            elif action < 0.95:
+                state.deactivate(username)
+                state.activate(username)
+            else:
+                conn = object()
+                state.add_connection(username, conn)
+                state.remove_connection(username, conn)
+    except Exception as e:
+        errors.append(e)
+
+
+def check_consistency(state):
+    # Every membership must be recorded on both sides of the index
+    problems = []
+    for name, room in state.rooms.items():
+        for username in room.members:
+            if state.user_room.get(username) != name:
+                problems.append(f"{username} in {name} but indexed in {state.user_room.get(username)}")
+    for username, name in state.user_room.items():
+        if username not in state.rooms[name].members:
+            problems.append(f"{username} indexed in {name} but not a member")
+    for username, conns in state.user_conns.items():
+        if len(conns) != 1:
+            problems.append(f"{username} has {len(conns)} connections")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer ChatState from many threads and check its indexes")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--users", type=int, default=20, help="users per thread")
+    parser.add_argument("--operations", type=int, default=20000, help="operations per thread")
+    args = parser.parse_args()
+
+    # Switch threads often to provoke races
+    sys.setswitchinterval(1e-6)
+    state = ChatState()
+    rooms = [f"room{i}" for i in range(args.rooms)]
+    for i, name in enumerate(rooms):
+        state.add_user(f"owner{i}", "password")
+        state.create_room(f"owner{i}", name)
+
+    errors = []
+    threads = [threading.Thread(target=worker, args=(state, i, rooms, args.users, args.operations, errors))
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    problems = check_consistency(state)
+    total = args.threads * args.operations
+    print(f"{total} operations on {args.threads} threads in {elapsed:.2f}s ({total / elapsed:.0f} ops/s)")
+    print(f"{len(errors)} errors, {len(problems)} inconsistencies")
+    for problem in (errors + problems)[:10]:
+        print(f"  {problem}")
+    sys.exit(1 if errors or problems else 0)
+
+
+if __name__ == '__main__':
+    main()
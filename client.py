@@ -1,19 +1,131 @@
 import socket
 import threading
+import time
+from collections import deque
+
+from protocol import (COMPRESSED_HANDSHAKE, EVENT, HANDSHAKE, HANDSHAKE_TIMEOUT, HANDSHAKES, RECV_SIZE, REPLY,
+                      REQUEST, FrameDecoder, ZlibCodec, encode_frame, format_event)
+
+# Chatrooms asked for at once when viewing the chatrooms
+VIEW_PAGE = 100
+# Seconds between the pings that tell the server the client is still there
+HEARTBEAT_INTERVAL = 20
 
 class ChatClient:
     # Constructor
-    def __init__(self, host='127.0.0.1', port=5000):
+    def __init__(self, host='127.0.0.1', port=5000, use_framing=True, compress=True, heartbeat=True):
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.username = None
         self.chatroom = None
         self.logged_in = False
+        # Framed protocol state, the text protocol is used if the server does not support it
+        self.use_framing = use_framing
+        self.framed = False
+        # Compression is asked for in the handshake and used if the server agrees
+        self.compress = compress
+        self.codec = None
+        self.decoder = FrameDecoder()
+        self.frames = deque()
+        self.request_id = 0
+        # The heartbeat thread sends too, frames must not interleave
+        self.heartbeat = heartbeat
+        self.send_lock = threading.Lock()
+        # Chatroom messages that arrived while waiting for a reply
+        self.events = deque()
+        # Chatroom name -> sequence number of the last message seen there
+        self.cursors = {}
 
     # Connect to server
     def connect(self):
         self.socket.connect((self.host, self.port))
+        if self.use_framing:
+            self.negotiate()
+        if self.framed and self.heartbeat:
+            threading.Thread(target=self.send_heartbeats, daemon=True).start()
+
+    # Ask for the framed protocol and fall back to text if the server does not answer
+    def negotiate(self):
+        self.socket.settimeout(HANDSHAKE_TIMEOUT)
+        reply = b""
+        try:
+            self.socket.sendall(COMPRESSED_HANDSHAKE if self.compress else HANDSHAKE)
+            while len(reply) < len(HANDSHAKE):
+                data = self.socket.recv(len(HANDSHAKE) - len(reply))
+                if not data:
+                    break
+                reply += data
+        except socket.timeout:
+            pass
+        finally:
+            self.socket.settimeout(None)
+        self.framed = reply in HANDSHAKES
+        if reply == COMPRESSED_HANDSHAKE:
+            self.codec = ZlibCodec()
+            self.decoder = FrameDecoder(self.codec)
+
+    # Send a command as a frame, or pipe separated in the text protocol
+    def send_command(self, *fields):
+        if self.framed:
+            self.request_id += 1
+            self.send_frame(fields, self.request_id)
+        else:
+            self.socket.sendall("|".join(str(field) for field in fields).encode())
+
+    def send_frame(self, fields, request_id):
+        frame = encode_frame(REQUEST, list(fields), request_id)
+        if self.codec is not None:
+            frame = self.codec.compress_frame(frame)
+        with self.send_lock:
+            self.socket.sendall(frame)
+
+    # Ping the server now and then, even while the menu waits for input. The
+    # pings use request id 0, which no command has, so their replies are skipped.
+    def send_heartbeats(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.send_frame(["PING"], 0)
+            except OSError:
+                break
+
+    # Read until at least one complete frame is available
+    def receive_frame(self):
+        while not self.frames:
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed by server")
+            self.frames.extend(self.decoder.feed(data))
+        return self.frames.popleft()
+
+    # Wait for the reply to the last command, keeping any chatroom messages for later
+    def receive_reply(self):
+        if not self.framed:
+            return self.socket.recv(RECV_SIZE).decode()
+        while True:
+            kind, request_id, fields = self.receive_frame()
+            if kind == REPLY:
+                if request_id == self.request_id:
+                    return fields[0]
+                continue
+            self.note_event(fields)
+            if fields[0] != "PING":
+                self.events.append(fields)
+
+    # Remember how far the history of a chatroom has been seen, to catch up from there later
+    def note_event(self, fields):
+        if fields[0] == "MESSAGE" and len(fields) > 5 and fields[5]:
+            self.cursors[fields[4]] = fields[5]
+        # The server checks that the client is still there
+        elif fields[0] == "PING":
+            self.send_frame(["PONG"], 0)
+
+    # Fields asking the server to replay the history after the last message seen in a chatroom
+    def cursor_fields(self, chatroom_name):
+        if chatroom_name in self.cursors:
+            return [self.cursors[chatroom_name]]
+        return []
     
     # Register a new user
     def register(self, username, password):
@@ -22,8 +134,8 @@ class ChatClient:
             print("You are already logged in.")
             return
         # Send registration request to server
-        self.socket.sendall(f"REGISTER|{username}|{password}".encode())
-        response = self.socket.recv(1024).decode()
+        self.send_command("REGISTER", username, password)
+        response = self.receive_reply()
 
         # Check if registration was successful
         if response == "SUCCESS":
@@ -40,8 +152,8 @@ class ChatClient:
             return
 
         # Send login request to server
-        self.socket.sendall(f"LOGIN|{username}|{password}".encode())
-        response = self.socket.recv(1024).decode()
+        self.send_command("LOGIN", username, password, *self.cursor_fields(self.chatroom))
+        response = self.receive_reply()
 
         # Check if login was successful
         if response == "SUCCESS":
@@ -66,8 +178,8 @@ class ChatClient:
     def logout(self):
         # Check if user is logged in
         if self.logged_in:
-            self.socket.sendall(f"LOGOUT|{self.username}".encode())
-            response = self.socket.recv(1024).decode()
+            self.send_command("LOGOUT", self.username)
+            response = self.receive_reply()
             # Check if logout was successful
             if "SUCCESS" in response:
                 self.logged_in = False
@@ -80,7 +192,7 @@ class ChatClient:
     def send_message(self, message):
         # Send message to server
         if self.logged_in and self.chatroom:
-            self.socket.sendall(f"MESSAGE|{self.username}|{message}".encode())
+            self.send_command("MESSAGE", self.username, message)
         # Check if user is logged in
         elif self.logged_in == False:
             print("You must be logged in to send messages.")
@@ -91,26 +203,56 @@ class ChatClient:
             return
 
         # Check if message was sent successfully
-        response = self.socket.recv(1024).decode()
-        if "ERROR: Message not sent" in response:
+        response = self.receive_reply()
+        if response.startswith("ERROR"):
             print(f"Error: {response}")
         else:
             while "SUCCESS" not in response:
-                response = self.socket.recv(1024).decode()
+                response = self.receive_reply()
+            print("Message sent!")
+
+
+    def direct_message(self, recipient, message):
+        # Send a message to one user, the server keeps it for them while they are offline
+        if self.logged_in == False:
+            print("You must be logged in to send direct messages.")
+            return
+        self.send_command("DIRECT_MESSAGE", self.username, recipient, message)
+        response = self.receive_reply()
+        if not response.startswith("SUCCESS"):
+            print(f"Error: {response}")
+        elif response == "SUCCESS|0":
+            print(f"{recipient} is offline and will get the message on their next login.")
+        else:
             print("Message sent!")
 
-    
     def receive_messages(self):
+        # Show the messages that arrived while waiting for replies
+        while self.events:
+            print(format_event(self.events.popleft()))
         # Receive messages from server
         while True:
             self.timeout = 60
             self.socket.settimeout(self.timeout)
             try:
-                data = self.socket.recv(1024).decode()
+                if self.framed:
+                    kind, request_id, fields = self.receive_frame()
+                    if kind == EVENT:
+                        self.note_event(fields)
+                        if fields[0] != "PING":
+                            print(format_event(fields))
+                    continue
+                data = self.socket.recv(RECV_SIZE).decode()
                 if not data:
                     break
                 print(data)
+            except ConnectionError:
+                break
             except socket.timeout:
+                # Framed servers answer the heartbeat, so silence means the server is gone
+                if self.framed and self.heartbeat:
+                    print("The server stopped answering.")
+                    break
                 if self.logged_in == False:
                     break
                 else:
@@ -120,11 +262,12 @@ class ChatClient:
                         continue
                     else:
                         break
+        self.socket.settimeout(None)
 
     def create_chatroom(self, chatroom_name):
         # Send chatroom creation request to server
         if self.logged_in and self.chatroom == None:
-            self.socket.sendall(f"CREATE_CHATROOM|{self.username}|{chatroom_name}".encode())
+            self.send_command("CREATE_CHATROOM", self.username, chatroom_name)
         # Check if user is logged in
         elif self.logged_in == False:
             print("You must be logged in to create chatrooms.")
@@ -135,7 +278,7 @@ class ChatClient:
             return
 
         # Check if chatroom was created successfully
-        response = self.socket.recv(1024).decode()
+        response = self.receive_reply()
         if response == "SUCCESS":
             print("Chatroom created!")
             self.chatroom = chatroom_name
@@ -145,7 +288,7 @@ class ChatClient:
     def join_chatroom(self, chatroom_name):
         # Send chatroom join request to server
         if self.logged_in and self.chatroom == None:
-            self.socket.sendall(f"JOIN_CHATROOM|{self.username}|{chatroom_name}".encode())
+            self.send_command("JOIN_CHATROOM", self.username, chatroom_name, *self.cursor_fields(chatroom_name))
         # Check if user is logged in
         elif self.logged_in == False:
             print("You must be logged in to join chatrooms.")
@@ -156,7 +299,7 @@ class ChatClient:
             return
         
         # Check if chatroom was joined successfully
-        response = self.socket.recv(1024).decode()
+        response = self.receive_reply()
         print(response)
         if response == "SUCCESS":
             print("Chatroom joined!")
@@ -167,7 +310,7 @@ class ChatClient:
     def leave_chatroom(self):
         # Send chatroom leave request to server
         if self.logged_in and self.chatroom:
-            self.socket.sendall(f"LEAVE_CHATROOM|{self.username}|{self.chatroom}".encode())
+            self.send_command("LEAVE_CHATROOM", self.username, self.chatroom)
         # Check if user is logged in
         elif self.logged_in == False:
             print("You must be logged in to leave chatrooms.")
@@ -178,7 +321,7 @@ class ChatClient:
             return
 
         # Check if chatroom was left successfully
-        response = self.socket.recv(1024).decode()
+        response = self.receive_reply()
         if response == "SUCCESS":
             print("Chatroom left!")
             self.chatroom = None
@@ -186,16 +329,52 @@ class ChatClient:
             print("Chatroom leave failed.")
 
     def view_chatrooms(self):
-        # Send chatroom view request to server
-        self.socket.sendall(f"VIEW_CHATROOMS".encode())
-        response = self.socket.recv(1024).decode()
-        print(response)
+        # Ask for the chatrooms a page at a time, so no reply is too big for one read
+        cursor = ""
+        while True:
+            self.send_command("VIEW_CHATROOMS", f"after={cursor}", f"limit={VIEW_PAGE}")
+            response = self.receive_reply()
+            if not response.startswith("SUCCESS"):
+                print(response)
+                return
+            header, _, listing = response.partition("\n")
+            cursor = header.split("|", 2)[2]
+            print(listing, end="")
+            if not cursor:
+                break
+
+    def view_history(self, limit=None):
+        # Check if user is in a chatroom
+        if self.logged_in == False or self.chatroom == None:
+            print("You must be in a chatroom to view its history.")
+            return
+        # Ask for the latest messages of the chatroom
+        self.send_command("HISTORY", self.username, "", *([limit] if limit else []))
+        response = self.receive_reply()
+        if not response.startswith("SUCCESS"):
+            print(f"History failed: {response}")
+            return
+        lines = response.split("\n")
+        count = int(lines[0].split("|")[1])
+        if self.framed:
+            # The messages follow the reply as events
+            while count > 0:
+                kind, request_id, fields = self.receive_frame()
+                if kind != EVENT:
+                    continue
+                self.note_event(fields)
+                if fields[0] == "MESSAGE":
+                    print(format_event(fields))
+                    count -= 1
+        else:
+            for line in lines[1:]:
+                print(line)
 
     def print_current_info(self):
         # Send current info request to server
         print(f"Username: {self.username}")
-        self.socket.sendall(f"CURRENT_INFO|{self.username}".encode())
-        response = self.socket.recv(1024).decode()
+        self.send_command("CURRENT_INFO", self.username)
+        response = self.receive_reply()
         if "SUCCESS" in response:
             self.chatroom = response.split('|')[1]
             print(f"Chatroom: {response.split('|')[1]}")
@@ -226,7 +405,9 @@ if __name__ == '__main__':
         print("8. View chatrooms")
         print("9. Print current info")
         print("10. Logout")
-        print("11. Exit\n")
+        print("11. View chatroom history")
+        print("12. Send direct message")
+        print("13. Exit\n")
 
         choice = input("Enter your choice: ")
 
@@ -259,6 +440,12 @@ if __name__ == '__main__':
         elif choice == "10":
             client.logout()
         elif choice == "11":
+            client.view_history()
+        elif choice == "12":
+            recipient = input("Enter the username of the recipient: ")
+            message = input("Enter your message: ")
+            client.direct_message(recipient, message)
+        elif choice == "13":
             if client.logged_in:
                 client.logout()
             client.socket.close()
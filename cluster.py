@@ -0,0 +1,110 @@
+import logging
+import socket
+import threading
+import time
+
+from connection import DISCONNECT, SocketConnection
+from protocol import HANDSHAKE, RECV_SIZE, REQUEST, FrameDecoder, ProtocolError, encode_frame
+from relay import BROADCAST, RELAY_QUEUE
+
+# Seconds between attempts to reach the relay
+RECONNECT_DELAY = 1
+# Users per frame when a node sends its state to a node that joined
+SYNC_CHUNK = 1000
+
+log = logging.getLogger("chat.cluster")
+
+
+def parse_address(address):
+    # host:port of the relay
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class ClusterLink:
+    # The connection of a chat server to the relay of its cluster. Changes are
+    # published from any thread without waiting on the network: they are queued
+    # and a writer thread sends them in batches. Frames of the other nodes are
+    # passed to apply(sender, fields) on the reader thread, one at a time and in
+    # the order each node sent them. Nothing is published while the relay is
+    # unreachable, so after connecting the link asks the oldest other node for
+    # its state with a SYNC frame and calls on_join(other node ids), which may
+    # offer the state of this node.
+    def __init__(self, address, node_id, apply, on_join=None):
+        self.address = parse_address(address)
+        self.node_id = node_id
+        self.apply = apply
+        self.on_join = on_join
+        # Connection to the relay, None while there is none
+        self.conn = None
+        self.published = 0
+        self.received = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.serve()
+            except (OSError, ProtocolError) as e:
+                log.warning("Lost the relay at %s:%s: %s", *self.address, e)
+            self.conn = None
+            time.sleep(RECONNECT_DELAY)
+
+    def serve(self):
+        relay_sock = socket.create_connection(self.address)
+        relay_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        relay_sock.sendall(HANDSHAKE)
+        data = b""
+        while len(data) < len(HANDSHAKE):
+            received = relay_sock.recv(RECV_SIZE)
+            if not received:
+                raise ConnectionError("Relay closed the connection")
+            data += received
+        if not data.startswith(HANDSHAKE):
+            raise ProtocolError("Not a relay")
+        relay_conn = SocketConnection(relay_sock, RELAY_QUEUE, DISCONNECT)
+        relay_conn.framed = True
+        relay_conn.sendall(encode_frame(REQUEST, ["HELLO", self.node_id]))
+        decoder = FrameDecoder()
+        frames = decoder.feed(data[len(HANDSHAKE):])
+        try:
+            while True:
+                for kind, request_id, fields in frames:
+                    if fields[0] == "NODES":
+                        self.joined(relay_conn, fields[1:])
+                    else:
+                        self.received += 1
+                        try:
+                            self.apply(fields[0], fields[1:])
+                        except Exception:
+                            log.exception("Could not apply a change from node %s", fields[0])
+                data = relay_sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError("Relay closed the connection")
+                frames = decoder.feed(data)
+        finally:
+            relay_conn.close()
+
+    def joined(self, relay_conn, others):
+        log.info("Joined the cluster at %s:%s with %s other nodes", *self.address, len(others))
+        self.conn = relay_conn
+        if others:
+            self.send(others[0], "SYNC")
+        if self.on_join is not None:
+            self.on_join(others)
+
+    def publish(self, *fields):
+        # Send a change to every other node
+        self.send(BROADCAST, *fields)
+
+    def send(self, node, *fields):
+        relay_conn = self.conn
+        if relay_conn is None:
+            return
+        try:
+            relay_conn.sendall(encode_frame(REQUEST, [node, *fields]))
+            self.published += 1
+        except ConnectionError:
+            pass
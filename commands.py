@@ -0,0 +1,143 @@
+import importlib
+import logging
+
+# Label of the latency histogram for commands nobody registered
+UNKNOWN = "unknown"
+
+log = logging.getLogger("chat.commands")
+
+# Key of Command types that gives the type of the fields after the named ones
+REST = "*"
+
+
+def anything(value):
+    # Type of a field taken as it comes, whatever it holds
+    return value
+
+
+def count(value):
+    # Type of a field that holds a number of things
+    value = int(value)
+    if value < 0:
+        raise ValueError("A count cannot be negative")
+    return value
+
+
+class Command:
+    # A command of the protocol: its handler and the fields it takes after the
+    # command name. Handlers are called as handler(client_conn, request_id,
+    # *fields), with None for optional fields that were left out, and with every
+    # field after the named ones when rest is True. Fields are text unless types
+    # maps their name, or REST for the fields after the named ones, to a type
+    # such as int or count that the field is converted to first. An empty
+    # optional field is left as it is.
+    __slots__ = ("name", "handler", "fields", "optional", "rest", "blocking", "seconds", "least", "most", "kinds",
+                 "rest_kind")
+
+    def __init__(self, name, handler, fields=(), optional=(), rest=False, blocking=False, seconds=None,
+                 types=None):
+        self.name = name
+        self.handler = handler
+        self.fields = tuple(fields)
+        self.optional = tuple(optional)
+        self.rest = rest
+        # Whether the handler may block, such as on password hashing. The
+        # asyncio server runs those on a thread.
+        self.blocking = blocking
+        # Latency histogram of the command, if the registry has one
+        self.seconds = seconds
+        # Bounds on the number of fields, the command name included
+        self.least = 1 + len(self.fields)
+        self.most = None if rest else self.least + len(self.optional)
+        # Type of each named field, then of the rest
+        types = types or {}
+        self.kinds = [types.get(field, str) for field in self.fields + self.optional]
+        self.rest_kind = types.get(REST, str)
+
+    def arguments(self, data):
+        # The fields to call the handler with, None if there are too few or one
+        # is not of its type. As in the original protocol, fields after the
+        # declared ones are ignored.
+        if len(data) < self.least:
+            return None
+        if self.rest or len(data) == self.most:
+            arguments = list(data[1:])
+        elif len(data) > self.most:
+            arguments = list(data[1:self.most])
+        else:
+            arguments = [*data[1:], *[None] * (self.most - len(data))]
+        kinds = self.kinds
+        for index, argument in enumerate(arguments):
+            kind = kinds[index] if index < len(kinds) else self.rest_kind
+            # A framed client may send numbers or bytes where text is expected
+            if kind is str:
+                if argument is not None and not isinstance(argument, str):
+                    return None
+            elif argument not in (None, ""):
+                try:
+                    arguments[index] = kind(argument)
+                except (TypeError, ValueError):
+                    return None
+        return arguments
+
+
+class CommandRegistry:
+    # Maps command names to their Command, so dispatching is one dict lookup
+    # and the fields are checked against what the command declared. Commands
+    # are registered by the server and by plugins alike. When given a labelled
+    # latency histogram every command gets its own child of it up front.
+    def __init__(self, seconds=None):
+        self.commands = {}
+        self.seconds = seconds
+        self.unknown_seconds = seconds.labels(UNKNOWN) if seconds is not None else None
+
+    def register(self, name, handler, fields=(), optional=(), rest=False, blocking=False, types=None):
+        # A later registration of the same name replaces the earlier one
+        command = Command(name, handler, fields, optional, rest, blocking,
+                          self.seconds.labels(name) if self.seconds is not None else None, types)
+        self.commands[name] = command
+        return command
+
+    def command(self, name, fields=(), optional=(), rest=False, blocking=False, types=None):
+        # Decorator form of register
+        def decorate(handler):
+            self.register(name, handler, fields, optional, rest, blocking, types)
+            return handler
+        return decorate
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def is_blocking(self, name):
+        command = self.commands.get(name)
+        return command is not None and command.blocking
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def dispatch(self, client_conn, data, request_id=0, command=None):
+        # Run a command, replying with an error if it is unknown or its fields do not fit
+        if not data:
+            client_conn.send_reply("ERROR: Malformed command", request_id)
+            return
+        if command is None:
+            command = self.commands.get(data[0])
+        if command is None:
+            client_conn.send_reply(f"ERROR: Unknown command {data[0]}", request_id)
+            return
+        arguments = command.arguments(data)
+        if arguments is None:
+            client_conn.send_reply("ERROR: Malformed command", request_id)
+            return
+        command.handler(client_conn, request_id, *arguments)
+
+
+def load_plugins(server, names):
+    # A plugin is a module with a register(server) function, which adds its
+    # commands to server.commands
+    for name in names:
+        importlib.import_module(name).register(server)
+        log.info("Loaded plugin %s", name)
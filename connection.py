@@ -0,0 +1,318 @@
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+
+from protocol import COMPRESSED_HANDSHAKE, HANDSHAKE, HANDSHAKES, REPLY, FrameDecoder, TextDecoder, encode_frame
+
+# Most buffers a single sendmsg call may take
+IOV_MAX = 1024
+
+# What to do when the outbound queue of a connection is full
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+BACKPRESSURE_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+# How many outgoing messages a connection may have waiting
+DEFAULT_MAX_QUEUE = 1024
+
+
+class QueueStats:
+    # Counters shared by the outbound queues of all connections of a server
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.max_depth = 0
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+    def add(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_push(self, queue_depth):
+        with self.lock:
+            self.queued += 1
+            self.depth += 1
+            if queue_depth > self.max_depth:
+                self.max_depth = queue_depth
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "queued": self.queued,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "disconnected": self.disconnected,
+            }
+
+
+class Connection:
+    # A client connection as seen by the server. The protocol is picked from the
+    # first bytes the client sends: the framed handshake or a plain text command.
+    # Framed clients may ask for compression, which is used when the server
+    # offers a codec. Everything sent to the client goes through a bounded queue
+    # that a writer drains, so a slow reader never blocks the thread that is
+    # sending to it.
+    def __init__(self, max_queue=DEFAULT_MAX_QUEUE, policy=DROP_OLDEST, stats=None, codec=None):
+        # A full queue must have a message to drop
+        if max_queue < 1:
+            raise ValueError("The outbound queue must hold at least one message")
+        self.framed = False
+        self.decoder = None
+        self.pending = b""
+        # The codec the server offers, and the one in use once the client asked for it
+        self.offered_codec = codec
+        self.codec = None
+        # The user that registered or logged in on this connection
+        self.username = None
+        # When the client last sent something, for the reaper
+        self.last_seen = time.monotonic()
+        # Collects the replies of the commands of a batch instead of sending them
+        self.replies = None
+
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.policy = policy
+        self.stats = stats if stats is not None else QueueStats()
+        self.dropped = 0
+        self.closed = False
+        # Set when the socket was handed over to another process
+        self.detached = False
+
+    def feed(self, data):
+        # Turn received bytes into a list of (kind, request id, fields) commands
+        self.last_seen = time.monotonic()
+        if self.decoder is None:
+            data = self.pending + data
+            # Wait for the rest of a handshake that was split across reads
+            if len(data) < len(HANDSHAKE) and any(handshake.startswith(data) for handshake in HANDSHAKES):
+                self.pending = data
+                return []
+            self.pending = b""
+            if data.startswith(HANDSHAKES):
+                if data.startswith(COMPRESSED_HANDSHAKE):
+                    self.codec = self.offered_codec
+                self.framed = True
+                self.decoder = FrameDecoder(self.codec)
+                self.sendall(COMPRESSED_HANDSHAKE if self.codec is not None else HANDSHAKE)
+                data = data[len(HANDSHAKE):]
+                if not data:
+                    return []
+            else:
+                self.decoder = TextDecoder()
+        return self.decoder.feed(data)
+
+    def send_reply(self, message, request_id=0):
+        # Reply to a command, echoing the request id of framed clients
+        if self.replies is not None:
+            self.replies.append(message)
+        elif self.framed:
+            self.send_frame(encode_frame(REPLY, [message], request_id))
+        else:
+            self.sendall(message.encode())
+
+    def send_reply_fields(self, fields, request_id=0):
+        # A reply of several fields, only framed clients can tell them apart
+        if self.replies is not None or not self.framed:
+            self.send_reply("\n".join(fields), request_id)
+        else:
+            self.send_frame(encode_frame(REPLY, fields, request_id))
+
+    def send_frame(self, frame):
+        if self.codec is not None:
+            frame = self.codec.compress_frame(frame)
+        self.sendall(frame)
+
+    def send_event(self, event):
+        # Push a message that was not asked for, like a chatroom message.
+        # The event is a PreparedEvent so a broadcast is only encoded, and
+        # compressed, once.
+        self.sendall(event.encoded(self.framed, self.codec))
+
+    def push(self, data):
+        # Add data to the outbound queue, applying the backpressure policy when it is full.
+        # Must be called with the queue protected against the writer.
+        if self.closed:
+            # A broadcast may still reach a connection that moved on, it is not a failure
+            if self.detached:
+                return True
+            raise ConnectionError("Connection closed")
+        if len(self.queue) >= self.max_queue:
+            if self.policy == DISCONNECT:
+                self.stats.add("disconnected")
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            self.stats.add("dropped")
+            self.stats.add("depth", -1)
+        self.queue.append(data)
+        self.stats.record_push(len(self.queue))
+        return True
+
+    def take(self):
+        # Remove everything that is waiting in the queue
+        batch = list(self.queue)
+        self.queue.clear()
+        self.stats.add("depth", -len(batch))
+        self.stats.add("sent", len(batch))
+        return batch
+
+    @property
+    def queue_depth(self):
+        return len(self.queue)
+
+    def sendall(self, data):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+def send_buffers(sock, buffers):
+    # Write a batch of buffers with as few system calls as possible
+    if len(buffers) == 1 or not hasattr(sock, "sendmsg"):
+        for data in buffers:
+            sock.sendall(data)
+        return
+    views = [memoryview(data) for data in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        # Skip the buffers that went out completely and trim a partially sent one
+        while index < len(views) and sent >= len(views[index]):
+            sent -= len(views[index])
+            index += 1
+        if sent:
+            views[index] = views[index][sent:]
+
+
+class SocketConnection(Connection):
+    # A connection served by a blocking socket, read by its own thread and
+    # written by a second one
+    def __init__(self, sock, max_queue=DEFAULT_MAX_QUEUE, policy=DROP_OLDEST, stats=None, codec=None):
+        super().__init__(max_queue, policy, stats, codec)
+        self.sock = sock
+        self.ready = threading.Condition()
+        # Whether the writer is sending a batch it took from the queue
+        self.sending = False
+        self.writer = threading.Thread(target=self.write_queue, daemon=True)
+        self.writer.start()
+
+    def sendall(self, data):
+        with self.ready:
+            accepted = self.push(data)
+            self.ready.notify_all()
+        if not accepted:
+            # Slow consumer, drop it
+            self.close()
+            raise ConnectionError("Outbound queue full")
+
+    def write_queue(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    break
+                batch = self.take()
+                self.sending = True
+            try:
+                send_buffers(self.sock, batch)
+            except OSError:
+                self.close()
+                break
+            finally:
+                with self.ready:
+                    self.sending = False
+                    self.ready.notify_all()
+
+    def detach(self, timeout=5):
+        # Stop serving the socket without closing the client connection, once
+        # everything queued has been sent. Returns the socket.
+        with self.ready:
+            self.ready.wait_for(lambda: self.closed or not (self.queue or self.sending), timeout)
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            self.closed = True
+            self.detached = True
+            self.stats.add("depth", -len(self.queue))
+            self.queue.clear()
+            self.ready.notify_all()
+        self.writer.join()
+        return self.sock
+
+    def close(self):
+        with self.ready:
+            if self.closed:
+                return
+            self.closed = True
+            self.stats.add("depth", -len(self.queue))
+            self.queue.clear()
+            self.ready.notify_all()
+        # Shutting down wakes up the thread blocked in recv
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class StreamConnection(Connection):
+    # Wraps an asyncio stream writer, with a task on the event loop draining the queue.
+    # Commands that run on other threads hand their writes over to the event loop.
+    # Size of the transport buffer above which the writer waits for the client
+    HIGH_WATER = 64 * 1024
+
+    def __init__(self, writer, max_queue=DEFAULT_MAX_QUEUE, policy=DROP_OLDEST, stats=None, codec=None):
+        super().__init__(max_queue, policy, stats, codec)
+        self.writer = writer
+        self.writer.transport.set_write_buffer_limits(high=self.HIGH_WATER)
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.writer_task = asyncio.ensure_future(self.write_queue())
+
+    def sendall(self, data):
+        if threading.get_ident() != self.loop_thread:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            self.loop.call_soon_threadsafe(self.send_from_loop, data)
+            return
+        if not self.push(data):
+            # Slow consumer, drop it
+            self.close()
+            raise ConnectionError("Outbound queue full")
+        self.ready.set()
+
+    def send_from_loop(self, data):
+        try:
+            self.sendall(data)
+        except ConnectionError:
+            pass
+
+    async def write_queue(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue and not self.closed:
+                    self.writer.writelines(self.take())
+                    # Wait while the client is not keeping up
+                    await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stats.add("depth", -len(self.queue))
+        self.queue.clear()
+        self.ready.set()
+        self.writer.close()
@@ -0,0 +1,117 @@
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+# Membership changes remembered for delta queries, older versions get the full listing
+DEFAULT_CHANGES = 10000
+
+
+def format_rooms(rooms, counts=False):
+    # One chatroom_name|username1,username2 line per chatroom, or chatroom_name|count
+    if counts:
+        lines = [f"{chatroom_name}|{len(members)}" for chatroom_name, members in rooms]
+    else:
+        lines = [f"{chatroom_name}|{','.join(members)}" if members else chatroom_name
+                 for chatroom_name, members in rooms]
+    return "".join(line + "\n" for line in lines)
+
+
+class DirectorySnapshot:
+    # Every chatroom with its members at one version, sorted by name
+    __slots__ = ("version", "names", "rooms", "listing")
+
+    def __init__(self, version, rooms):
+        self.version = version
+        self.rooms = rooms
+        self.names = [chatroom_name for chatroom_name, members in rooms]
+        # The full VIEW_CHATROOMS reply, made on first use
+        self.listing = None
+
+    def full_listing(self):
+        if self.listing is None:
+            self.listing = format_rooms(self.rooms)
+        return self.listing
+
+
+class RoomDirectory:
+    # The chatroom listing of a ChatState, built once per version. The version
+    # goes up with every membership change, and the latest changes are kept so
+    # a client can ask for only what changed since the version it has.
+    def __init__(self, state, max_changes=DEFAULT_CHANGES):
+        self.state = state
+        self.lock = threading.Lock()
+        self.version = 0
+        # (version, chatroom name) of the latest changes, oldest first
+        self.changes = deque(maxlen=max_changes)
+        self.snapshot = DirectorySnapshot(0, [])
+
+    def changed(self, chatroom_name):
+        # Called after the members of a chatroom changed, without holding its lock
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, chatroom_name))
+
+    def reset(self):
+        # The chatrooms were replaced all at once, deltas from before are unknown
+        with self.lock:
+            self.version += 1
+            self.changes.clear()
+
+    def current(self):
+        # The snapshot of the current version, rebuilt only when something changed
+        snapshot = self.snapshot
+        version = self.version
+        if snapshot.version == version:
+            return snapshot
+        # Build without the lock, the room locks are taken while reading the members
+        snapshot = DirectorySnapshot(version, sorted(self.state.room_listing()))
+        with self.lock:
+            if snapshot.version > self.snapshot.version:
+                self.snapshot = snapshot
+        return snapshot
+
+    def page(self, prefix="", after="", limit=None):
+        # Chatrooms whose name starts with prefix, after the cursor, at most limit of them.
+        # Returns the version, the chatrooms and whether more follow.
+        snapshot = self.current()
+        names = snapshot.names
+        start = bisect_left(names, prefix)
+        if after:
+            start = max(start, bisect_right(names, after))
+        end = start
+        while end < len(names) and names[end].startswith(prefix) and (limit is None or end - start < limit):
+            end += 1
+        more = end < len(names) and names[end].startswith(prefix)
+        return snapshot.version, snapshot.rooms[start:end], more
+
+    def changes_since(self, version):
+        # The chatrooms that changed after version with their current members.
+        # Returns the version and the chatrooms, which are None when the
+        # changes since then are no longer known.
+        with self.lock:
+            current = self.version
+            oldest = self.changes[0][0] if self.changes else current + 1
+            if version > current or version < oldest - 1:
+                return current, None
+            changed = set()
+            for change_version, chatroom_name in reversed(self.changes):
+                if change_version <= version:
+                    break
+                changed.add(chatroom_name)
+        return current, [(chatroom_name, self.state.members(chatroom_name)) for chatroom_name in sorted(changed)]
+
+    def since_rooms(self, version, prefix=""):
+        # changes_since, limited to the chatrooms whose name starts with prefix
+        current, rooms = self.changes_since(version)
+        if rooms is not None and prefix:
+            rooms = [room for room in rooms if room[0].startswith(prefix)]
+        return current, rooms
+
+
+def parse_options(fields):
+    # VIEW_CHATROOMS options come as key=value fields
+    options = {}
+    for field in fields:
+        key, _, value = str(field).partition("=")
+        options[key] = value
+    return options
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+# Messages kept per chatroom
+DEFAULT_CAPACITY = 100
+# Memory all chatrooms together may use for their recent messages
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Rough cost of a buffered message on top of its text, for the memory cap
+ENTRY_OVERHEAD = 200
+
+
+class RoomHistory:
+    __slots__ = ("events", "size")
+
+    def __init__(self, capacity):
+        # Ring buffer of (seq, event, size), oldest first
+        self.events = deque(maxlen=capacity)
+        self.size = 0
+
+
+class RecentHistory:
+    # The latest messages of every chatroom, kept as the PreparedEvents that were
+    # broadcast, so serving them needs no formatting, encoding or disk reads.
+    # Every room keeps at most capacity messages, and when all rooms together
+    # go over max_bytes the rooms that have been idle the longest are dropped.
+    # A capacity of 0 keeps nothing.
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_bytes=DEFAULT_MAX_BYTES):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Chatroom name -> RoomHistory, least recently used first
+        self.rooms = OrderedDict()
+        self.size = 0
+
+    def add(self, chatroom_name, seq, event):
+        if self.capacity <= 0:
+            return
+        # Both encodings of the event end up cached on it, so count the text twice
+        size = 2 * sum(len(field) for field in event.fields if isinstance(field, str)) + ENTRY_OVERHEAD
+        with self.lock:
+            room = self.rooms.get(chatroom_name)
+            if room is None:
+                room = self.rooms[chatroom_name] = RoomHistory(self.capacity)
+            else:
+                self.rooms.move_to_end(chatroom_name)
+            if len(room.events) == self.capacity:
+                room.size -= room.events[0][2]
+                self.size -= room.events[0][2]
+            room.events.append((seq, event, size))
+            room.size += size
+            self.size += size
+            # Evict idle rooms, but never the one that is being written to
+            while self.size > self.max_bytes and len(self.rooms) > 1:
+                _, evicted = self.rooms.popitem(last=False)
+                self.size -= evicted.size
+
+    def get(self, chatroom_name, since=None, limit=None):
+        # The buffered events after since, oldest first, or the latest limit events.
+        # Returns None when the buffer does not hold all of them.
+        if self.capacity <= 0:
+            return None
+        limit = self.capacity if limit is None else limit
+        with self.lock:
+            room = self.rooms.get(chatroom_name)
+            if room is None or not room.events:
+                return None
+            self.rooms.move_to_end(chatroom_name)
+            events = room.events
+            oldest = events[0][0]
+            if since is None:
+                # Everything is here if the buffer has enough or starts at the first message
+                if len(events) < limit and oldest > 1:
+                    return None
+                return [event for seq, event, size in islice(events, max(0, len(events) - limit), None)]
+            if since + 1 < oldest:
+                return None
+            start = since + 1 - oldest
+            return [event for seq, event, size in islice(events, start, start + limit)]
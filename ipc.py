@@ -0,0 +1,99 @@
+import os
+import socket
+import threading
+import time
+
+from protocol import RECV_SIZE, REPLY, REQUEST, FrameDecoder, encode_frame
+
+# Most file descriptors accepted with one read
+MAX_FDS = 16
+# How long a client keeps trying to reach a server that is still starting
+CONNECT_TIMEOUT = 10
+
+
+class IpcServer:
+    # Answers requests from the other processes of the server on a Unix socket.
+    # Requests and replies are frames of the chat protocol, and a request may
+    # carry file descriptors, which the handler takes from the list it is given.
+    def __init__(self, path, handler):
+        self.path = path
+        self.handler = handler
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+
+    def start(self):
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            peer, _ = self.sock.accept()
+            threading.Thread(target=self.handle_peer, args=(peer,), daemon=True).start()
+
+    def handle_peer(self, peer):
+        decoder = FrameDecoder()
+        fds = []
+        with peer:
+            while True:
+                data, received_fds, flags, address = socket.recv_fds(peer, RECV_SIZE, MAX_FDS)
+                if not data:
+                    break
+                fds.extend(received_fds)
+                for kind, request_id, fields in decoder.feed(data):
+                    try:
+                        reply = self.handler(fields, fds)
+                    except Exception as e:
+                        reply = [f"ERROR: {e}"]
+                    peer.sendall(encode_frame(REPLY, reply, request_id))
+        # Do not leak descriptors nobody took
+        for fd in fds:
+            os.close(fd)
+
+
+class IpcClient:
+    # Calls an IpcServer. Every thread has its own connection, so calls from
+    # different threads never wait for each other.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def call(self, *fields, fds=()):
+        # Send a request and wait for its reply fields
+        if getattr(self.local, "sock", None) is None:
+            self.local.sock = self.connect()
+            self.local.decoder = FrameDecoder()
+        sock, decoder = self.local.sock, self.local.decoder
+        frame = encode_frame(REQUEST, list(fields))
+        try:
+            if fds:
+                sent = socket.send_fds(sock, [frame], list(fds))
+                sock.sendall(frame[sent:])
+            else:
+                sock.sendall(frame)
+            frames = []
+            while not frames:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError(f"{self.path} closed the connection")
+                frames = decoder.feed(data)
+        except OSError:
+            # Reconnect on the next call
+            sock.close()
+            self.local.sock = None
+            raise
+        return frames[0][2]
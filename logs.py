@@ -0,0 +1,75 @@
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Records per second each place in the code may log, and how many it may log at once
+RATE = 20
+BURST = 100
+# Records waiting for the writer thread, more are dropped
+QUEUE_SIZE = 10000
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
+class RateLimitFilter(logging.Filter):
+    # A token bucket per logging call site. Records over the rate are dropped and
+    # the next record that gets through says how many were.
+    def __init__(self, rate=RATE, burst=BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # (file, line) -> [tokens, last refill, suppressed records]
+        self.buckets = {}
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Hands records to the writer thread and never blocks the caller
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(level="INFO", rate=RATE, burst=BURST, stream=None):
+    # Log the chat server's records from a background thread, so a slow
+    # terminal or disk never holds up a thread that is serving clients
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(rate, burst))
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("chat")
+    logger.setLevel(level)
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    return listener
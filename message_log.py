@@ -0,0 +1,214 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+# Record layout: body length | crc32 of body | body
+RECORD_HEADER = struct.Struct("!II")
+# Body layout: sequence number | lengths of room, timestamp, username, message | the four strings
+BODY_HEADER = struct.Struct("!QHHHI")
+
+# Size after which a new segment file is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Longest time an appended message waits for fsync
+FLUSH_INTERVAL = 0.05
+# Number of appended messages that triggers an fsync right away
+FLUSH_BATCH = 512
+
+# A position packs the segment number above the offset inside the segment
+OFFSET_BITS = 40
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+
+def segment_name(segment):
+    return f"segment-{segment:08d}.log"
+
+
+class MessageLog:
+    # Append-only, on-disk log of chatroom messages. Records are written to
+    # numbered segment files and synced to disk in batches by a background thread.
+    # Every room numbers its messages from 1, and the index keeps one packed
+    # position per message so any sequence number is found in O(1).
+    # Reads go through memory maps of the segments instead of file reads.
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, flush_interval=FLUSH_INTERVAL, flush_batch=FLUSH_BATCH):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        os.makedirs(directory, exist_ok=True)
+
+        # Protects the index and the file being appended to
+        self.lock = threading.Lock()
+        # Protects the memory maps
+        self.map_lock = threading.Lock()
+        # Room name -> positions of its messages, the message with sequence number n is at n - 1
+        self.index = {}
+        # Segment number -> memory map of the segment
+        self.maps = {}
+
+        self.segment = self.recover()
+        self.file = open(self.path(self.segment), "ab")
+        self.offset = self.file.tell()
+        self.unsynced = 0
+
+        self.closing = False
+        self.wake = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def path(self, segment):
+        return os.path.join(self.directory, segment_name(segment))
+
+    def recover(self):
+        # Rebuild the index from the segments on disk, returns the segment to append to
+        segments = sorted(int(name[8:16]) for name in os.listdir(self.directory)
+                          if name.startswith("segment-") and name.endswith(".log"))
+        for segment in segments:
+            valid = self.scan(segment)
+            # Cut off a record that was only partly written before a crash
+            if valid < os.path.getsize(self.path(segment)):
+                with open(self.path(segment), "r+b") as f:
+                    f.truncate(valid)
+        return segments[-1] if segments else 1
+
+    def scan(self, segment):
+        # Index the records of a segment, returns the offset after the last valid one
+        with open(self.path(segment), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = 0
+        try:
+            while offset + RECORD_HEADER.size <= len(data):
+                length, checksum = RECORD_HEADER.unpack_from(data, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > len(data) or zlib.crc32(data[offset + RECORD_HEADER.size:end]) != checksum:
+                    break
+                seq, room_len = BODY_HEADER.unpack_from(data, offset + RECORD_HEADER.size)[:2]
+                start = offset + RECORD_HEADER.size + BODY_HEADER.size
+                room = data[start:start + room_len].decode()
+                positions = self.index.setdefault(room, array("Q"))
+                if seq != len(positions) + 1:
+                    break
+                positions.append(segment << OFFSET_BITS | offset)
+                offset = end
+        finally:
+            data.close()
+        return offset
+
+    def append(self, room, timestamp, username, message):
+        # Add a message to the log and return its sequence number in the room
+        strings = [room.encode(), timestamp.encode(), username.encode(), message.encode()]
+        with self.lock:
+            positions = self.index.setdefault(room, array("Q"))
+            seq = len(positions) + 1
+            body = BODY_HEADER.pack(seq, *[len(s) for s in strings]) + b"".join(strings)
+            record = RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+            if self.offset and self.offset + len(record) > self.segment_size:
+                self.rotate()
+            positions.append(self.segment << OFFSET_BITS | self.offset)
+            self.file.write(record)
+            self.offset += len(record)
+            self.unsynced += 1
+            if self.unsynced >= self.flush_batch:
+                self.wake.set()
+        return seq
+
+    def rotate(self):
+        # Seal the current segment and start the next one, called with the lock held
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.unsynced = 0
+        self.segment += 1
+        self.file = open(self.path(self.segment), "ab")
+        self.offset = 0
+
+    def last_seq(self, room):
+        with self.lock:
+            return len(self.index.get(room, ()))
+
+    def read(self, room, since=None, limit=None):
+        # Messages of a room as (seq, timestamp, username, message). With since, the
+        # messages after that sequence number, oldest first, else the latest ones.
+        with self.lock:
+            positions = self.index.get(room)
+            if not positions:
+                return []
+            if since is not None:
+                start = max(0, since)
+                end = len(positions) if limit is None else min(len(positions), start + limit)
+            else:
+                end = len(positions)
+                start = 0 if limit is None else max(0, end - limit)
+            wanted = positions[start:end]
+            # Make sure what the maps will look at has left the write buffer
+            if wanted and wanted[-1] >> OFFSET_BITS == self.segment:
+                self.file.flush()
+        with self.map_lock:
+            return [self.read_record(position) for position in wanted]
+
+    def read_record(self, position):
+        # Decode one record straight out of the memory map, called with the map lock held
+        segment, offset = position >> OFFSET_BITS, position & OFFSET_MASK
+        data = self.map(segment, offset + RECORD_HEADER.size + BODY_HEADER.size)
+        length = RECORD_HEADER.unpack_from(data, offset)[0]
+        data = self.map(segment, offset + RECORD_HEADER.size + length)
+        start = offset + RECORD_HEADER.size
+        seq, *lengths = BODY_HEADER.unpack_from(data, start)
+        start += BODY_HEADER.size
+        view = memoryview(data)
+        try:
+            fields = []
+            for length in lengths:
+                fields.append(str(view[start:start + length], "utf-8"))
+                start += length
+        finally:
+            view.release()
+        room, timestamp, username, message = fields
+        return seq, timestamp, username, message
+
+    def map(self, segment, needed):
+        # Memory map of a segment covering at least the first needed bytes
+        data = self.maps.get(segment)
+        if data is None or len(data) < needed:
+            if data is not None:
+                data.close()
+            with open(self.path(segment), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = data
+        return data
+
+    def flush_loop(self):
+        while not self.closing:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.sync()
+
+    def sync(self):
+        # Write out and fsync everything appended so far
+        with self.lock:
+            if not self.unsynced or self.file.closed:
+                return
+            self.file.flush()
+            self.unsynced = 0
+            # Sync a duplicate so appends can continue and a rotation cannot close it
+            fd = os.dup(self.file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.closing = True
+        self.wake.set()
+        self.flusher.join()
+        self.sync()
+        with self.lock:
+            self.file.close()
+        with self.map_lock:
+            for data in self.maps.values():
+                data.close()
+            self.maps.clear()
@@ -0,0 +1,186 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets, 50 us to about 6.5 s
+TIME_BUCKETS = tuple(0.00005 * 2 ** i for i in range(18))
+# Upper bounds of the fan-out size buckets
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+
+class Counter:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    # Counts observations in fixed buckets, observing is a binary search and an increment
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One slot per bucket plus one for values above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), counts):
+            cumulative += count
+            samples.append((f"{name}_bucket", labels + (("le", format_value(bound)),), cumulative))
+        samples.append((f"{name}_sum", labels, total))
+        samples.append((f"{name}_count", labels, cumulative))
+        return samples
+
+
+class Family:
+    # A metric with all its label combinations
+    def __init__(self, name, kind, description, label_names, factory):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.label_names = label_names
+        self.factory = factory
+        # Tuple of label values -> metric
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def samples(self):
+        samples = []
+        for values, child in list(self.children.items()):
+            samples += child.samples(self.name, tuple(zip(self.label_names, values)))
+        return samples
+
+
+class Metrics:
+    # Registry of the metrics of a server, rendered in the Prometheus text format.
+    # Values that already exist elsewhere are read by collectors when rendering,
+    # so keeping them costs nothing while serving.
+    def __init__(self):
+        self.families = []
+        self.collectors = []
+
+    def add(self, name, kind, description, label_names, factory):
+        family = Family(name, kind, description, tuple(label_names), factory)
+        self.families.append(family)
+        # Metrics without labels are used directly
+        return family if label_names else family.labels()
+
+    def counter(self, name, description, label_names=()):
+        return self.add(name, "counter", description, label_names, Counter)
+
+    def gauge(self, name, description, label_names=()):
+        return self.add(name, "gauge", description, label_names, Gauge)
+
+    def histogram(self, name, description, label_names=(), buckets=TIME_BUCKETS):
+        return self.add(name, "histogram", description, label_names, lambda: Histogram(tuple(buckets)))
+
+    def collect(self, collector):
+        # collector() returns (name, kind, description, value) tuples
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.append(f"# HELP {family.name} {family.description}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            lines += [format_sample(*sample) for sample in family.samples()]
+        for collector in self.collectors:
+            for name, kind, description, value in collector():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(format_sample(name, (), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_sample(name, labels, value):
+    if labels:
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+        return f"{name}{{{label_text}}} {format_value(value)}"
+    return f"{name} {format_value(value)}"
+
+
+class MetricsServer:
+    # Serves the metrics over HTTP on a local port, on its own threads. When
+    # given the rate limits of the server, GET /limits shows them and
+    # POST /limits with scope=RATE/BURST pairs changes them.
+    def __init__(self, metrics, host, port, limits=None):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if limits is not None and self.path == "/limits":
+                    self.respond(200, limits.describe())
+                else:
+                    self.respond(200, metrics.render(), "text/plain; version=0.0.4")
+
+            def do_POST(self):
+                if limits is None or self.path != "/limits":
+                    self.respond(404, "Not found\n")
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    limits.update(body.decode())
+                except (ValueError, UnicodeDecodeError) as e:
+                    self.respond(400, f"{e}\n")
+                    return
+                self.respond(200, limits.describe())
+
+            def respond(self, status, text, content_type="text/plain"):
+                body = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
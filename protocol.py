@@ -0,0 +1,229 @@
+import struct
+import zlib
+
+# Sent by a client right after connecting to ask for the framed protocol.
+# The text protocol never starts with a NUL byte, so the server can tell them apart.
+HANDSHAKE = b"\x00CHT\x01"
+# Sent instead by a client that can also take compressed frames. A server that
+# agrees answers with the same bytes, one that does not answers with HANDSHAKE.
+COMPRESSED_HANDSHAKE = b"\x00CHT\x02"
+HANDSHAKES = (HANDSHAKE, COMPRESSED_HANDSHAKE)
+# How long a client waits for the server to accept the handshake
+HANDSHAKE_TIMEOUT = 2
+
+# Frame kinds
+REQUEST = 1
+REPLY = 2
+EVENT = 3
+# Set in the kind of a frame whose body after the kind is deflated
+COMPRESSED = 0x80
+
+# Field types
+FIELD_STR = 1
+FIELD_BYTES = 2
+FIELD_INT = 3
+
+# Frame layout: length | kind | request id | field count | fields...
+# The length covers everything after the length itself.
+LENGTH = struct.Struct("!I")
+FRAME_HEADER = struct.Struct("!BIH")
+# What follows the kind, the start of a compressed body once inflated
+KIND_SIZE = 1
+AFTER_KIND = struct.Struct("!IH")
+# Field layout: type | length | data
+FIELD_HEADER = struct.Struct("!BI")
+INT_VALUE = struct.Struct("!q")
+
+# Largest frame a peer may send
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# How much to read from a socket at once
+RECV_SIZE = 64 * 1024
+# Frames shorter than this are sent uncompressed, deflate cannot gain much on them
+DEFAULT_COMPRESS_THRESHOLD = 128
+# Deflate window and memory level. Every frame starts a new compressor, and a
+# small state sets up several times faster while compressing frames as well.
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_field(value):
+    if isinstance(value, str):
+        data = value.encode()
+        return FIELD_HEADER.pack(FIELD_STR, len(data)) + data
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return FIELD_HEADER.pack(FIELD_BYTES, len(value)) + bytes(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return FIELD_HEADER.pack(FIELD_INT, INT_VALUE.size) + INT_VALUE.pack(value)
+    raise ProtocolError(f"Unsupported field type {type(value).__name__}")
+
+
+def encode_frame(kind, fields, request_id=0):
+    body = b"".join([FRAME_HEADER.pack(kind, request_id, len(fields))] + [encode_field(field) for field in fields])
+    return LENGTH.pack(len(body)) + body
+
+
+def decode_fields(payload, offset, count):
+    fields = []
+    for _ in range(count):
+        if offset + FIELD_HEADER.size > len(payload):
+            raise ProtocolError("Truncated field header")
+        field_type, length = FIELD_HEADER.unpack_from(payload, offset)
+        offset += FIELD_HEADER.size
+        if offset + length > len(payload):
+            raise ProtocolError("Truncated field")
+        data = payload[offset:offset + length]
+        offset += length
+        if field_type == FIELD_STR:
+            fields.append(bytes(data).decode())
+        elif field_type == FIELD_BYTES:
+            fields.append(bytes(data))
+        elif field_type == FIELD_INT:
+            fields.append(INT_VALUE.unpack(data)[0])
+        else:
+            raise ProtocolError(f"Unknown field type {field_type}")
+    return fields
+
+
+class FrameDecoder:
+    # Reassembles frames from a stream of reads, any number of frames per read.
+    # Compressed frames are inflated with the codec of the connection.
+    def __init__(self, codec=None):
+        self.buffer = bytearray()
+        self.codec = codec
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        view = memoryview(self.buffer)
+        try:
+            while len(self.buffer) - offset >= LENGTH.size:
+                (length,) = LENGTH.unpack_from(self.buffer, offset)
+                if length > MAX_FRAME_SIZE:
+                    raise ProtocolError(f"Frame of {length} bytes is too large")
+                if length < KIND_SIZE:
+                    raise ProtocolError("Frame is too short")
+                end = offset + LENGTH.size + length
+                if end > len(self.buffer):
+                    break
+                frames.append(self.decode_frame(view, offset + LENGTH.size, end))
+                offset = end
+        finally:
+            view.release()
+        # Drop everything that has been consumed, keep the partial frame
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+    def decode_frame(self, view, start, end):
+        # The kind, request id and fields of the frame between start and end.
+        # Slices of the buffer must not outlive the call, it is resized afterwards.
+        kind = view[start]
+        if kind & COMPRESSED:
+            if self.codec is None:
+                raise ProtocolError("Compressed frame on an uncompressed connection")
+            kind &= ~COMPRESSED
+            payload = self.codec.inflate(view[start + KIND_SIZE:end])
+            start = 0
+        else:
+            payload = view[:end]
+            start += KIND_SIZE
+        if len(payload) - start < AFTER_KIND.size:
+            raise ProtocolError("Frame is too short")
+        request_id, count = AFTER_KIND.unpack_from(payload, start)
+        return kind, request_id, decode_fields(payload, start + AFTER_KIND.size, count)
+
+
+class ZlibCodec:
+    # Deflates frames with a preset dictionary known to both sides, so even short
+    # chatroom messages find something to refer back to. Every frame is
+    # compressed on its own, which lets a broadcast be compressed once and the
+    # same bytes be sent to every connection that uses the codec.
+    name = "zlib"
+
+    def __init__(self, threshold=DEFAULT_COMPRESS_THRESHOLD, level=6, dictionary=None):
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary if dictionary is not None else ZLIB_DICTIONARY
+
+    def compress_frame(self, frame):
+        # The frame compressed, or unchanged when it is short or would not shrink
+        if len(frame) < self.threshold:
+            return frame
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zdict=self.dictionary)
+        data = compressor.compress(memoryview(frame)[LENGTH.size + KIND_SIZE:]) + compressor.flush()
+        if KIND_SIZE + len(data) >= len(frame) - LENGTH.size:
+            return frame
+        return LENGTH.pack(KIND_SIZE + len(data)) + bytes([frame[LENGTH.size] | COMPRESSED]) + data
+
+    def inflate(self, data):
+        # The body of a compressed frame after its kind
+        decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=self.dictionary)
+        try:
+            body = decompressor.decompress(data, MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"Bad compressed frame: {e}")
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("Compressed frame is too large")
+        return body
+
+
+class TextDecoder:
+    # The original protocol: every read is one pipe separated command
+    def feed(self, data):
+        return [(REQUEST, 0, data.decode().split("|"))]
+
+
+class PreparedEvent:
+    # An event that is encoded at most once per wire format and codec and then
+    # shared, unchanged, by every connection it is sent to
+    __slots__ = ("fields", "framed", "text", "compressed")
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.framed = None
+        self.text = None
+        # Codec -> the frame compressed with it
+        self.compressed = None
+
+    def encoded(self, framed, codec=None):
+        if framed:
+            if self.framed is None:
+                self.framed = encode_frame(EVENT, self.fields)
+            if codec is None:
+                return self.framed
+            if self.compressed is None:
+                self.compressed = {}
+            data = self.compressed.get(codec)
+            if data is None:
+                data = self.compressed[codec] = codec.compress_frame(self.framed)
+            return data
+        if self.text is None:
+            self.text = format_event(self.fields).encode()
+        return self.text
+
+
+def format_event(fields):
+    # Render an event frame the way the text protocol sends it
+    if fields and fields[0] == "MESSAGE":
+        timestamp, username, message = fields[1:4]
+        return f"[{timestamp}] {username}: {message}"
+    if fields and fields[0] == "DIRECT_MESSAGE":
+        timestamp, username, message = fields[1:4]
+        return f"[{timestamp}] {username} (direct): {message}"
+    return "|".join(str(field) for field in fields)
+
+
+# The preset dictionary of ZlibCodec: frames and words that are common in a chat
+# session, the most frequent last. Changing it changes the wire format.
+ZLIB_DICTIONARY = b"".join([
+    b" the and you that have for not with this but what are was from they will about just know like"
+    b" there your can get all out when then time one would some how good think",
+    b"Client not registered|Chatroom does not exist|Chatroom already exists|ERROR: ",
+    encode_frame(REPLY, ["SUCCESS"], 1),
+    encode_frame(EVENT, ["MESSAGE", "2020-01-01 12:00:00", "username", "message", "chatroom", 1]),
+])
@@ -0,0 +1,130 @@
+import threading
+import time
+from array import array
+from urllib.parse import parse_qsl
+
+# Default limits as tokens per second and burst, a rate of 0 turns a limit off.
+# Every command of a connection takes a token, PING and PONG excepted,
+DEFAULT_CONNECTION_LIMIT = (200, 2000)
+# and every chatroom message takes one from its user and one from its chatroom
+DEFAULT_USER_LIMIT = (50, 200)
+DEFAULT_ROOM_LIMIT = (2000, 5000)
+# Keys a limiter holds before it first sweeps out the ones with a full bucket
+MIN_SWEEP = 1024
+
+
+class RateLimiter:
+    # Token buckets for any number of keys, such as users or connections. A
+    # bucket is only the tokens it had and when, kept in two arrays of floats
+    # with a dict from key to slot. Buckets are refilled when they are checked,
+    # so a check is O(1) and nothing runs in the background. A full bucket is
+    # the same as no bucket, those are swept out whenever the number of keys has
+    # doubled and their slots are used again.
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+        # Key -> slot in the arrays
+        self.slots = {}
+        self.tokens = array("d")
+        self.updated = array("d")
+        self.free = []
+        self.sweep_at = MIN_SWEEP
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        # Buckets keep their tokens, at most the new burst from their next check on
+        if rate < 0 or (rate and burst < 1):
+            raise ValueError("The rate may not be negative and the burst must be at least 1")
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            if not rate:
+                self.slots.clear()
+                del self.tokens[:], self.updated[:], self.free[:]
+
+    def allow(self, key, cost=1):
+        # Take tokens from the bucket of a key, returns False if it has too few
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.add(key, now)
+            tokens = min(self.burst, self.tokens[slot] + (now - self.updated[slot]) * self.rate)
+            self.updated[slot] = now
+            if tokens < cost:
+                self.tokens[slot] = tokens
+                return False
+            self.tokens[slot] = tokens - cost
+            return True
+
+    def add(self, key, now):
+        # Must be called with the lock held, a new key starts with a full bucket
+        if len(self.slots) >= self.sweep_at:
+            self.sweep(now)
+        if self.free:
+            slot = self.free.pop()
+            self.tokens[slot] = self.burst
+            self.updated[slot] = now
+        else:
+            slot = len(self.tokens)
+            self.tokens.append(self.burst)
+            self.updated.append(now)
+        self.slots[key] = slot
+        return slot
+
+    def sweep(self, now):
+        # Must be called with the lock held
+        full = [key for key, slot in self.slots.items()
+                if self.tokens[slot] + (now - self.updated[slot]) * self.rate >= self.burst]
+        for key in full:
+            self.free.append(self.slots.pop(key))
+        self.sweep_at = max(MIN_SWEEP, 2 * len(self.slots))
+
+    def __len__(self):
+        return len(self.slots)
+
+
+def parse_limit(text):
+    # RATE or RATE/BURST, the burst is the rate (and at least 1) when left out
+    rate, _, burst = str(text).partition("/")
+    rate = float(rate)
+    return rate, float(burst) if burst else max(rate, 1)
+
+
+def format_limit(rate, burst):
+    return f"{rate:g}/{burst:g}" if rate else "0"
+
+
+class RateLimits:
+    # The limiters of a server by scope, which can be changed while it runs
+    SCOPES = ("connection", "user", "chatroom")
+
+    def __init__(self, connection=DEFAULT_CONNECTION_LIMIT, user=DEFAULT_USER_LIMIT, chatroom=DEFAULT_ROOM_LIMIT):
+        self.connection = RateLimiter(*connection)
+        self.user = RateLimiter(*user)
+        self.chatroom = RateLimiter(*chatroom)
+
+    def limiter(self, scope):
+        if scope not in self.SCOPES:
+            raise ValueError(f"Unknown rate limit {scope}, expected one of {', '.join(self.SCOPES)}")
+        return getattr(self, scope)
+
+    def describe(self):
+        # One scope=RATE/BURST line per limit
+        return "".join(f"{scope}={format_limit(self.limiter(scope).rate, self.limiter(scope).burst)}\n"
+                       for scope in self.SCOPES)
+
+    def update(self, text):
+        # Takes scope=RATE/BURST pairs separated by & or new lines. Nothing
+        # changes unless every pair is valid.
+        changes = []
+        for line in text.splitlines():
+            for scope, limit in parse_qsl(line.strip(), strict_parsing=bool(line.strip())):
+                limiter = self.limiter(scope)
+                rate, burst = parse_limit(limit)
+                if rate < 0 or (rate and burst < 1):
+                    raise ValueError(f"Invalid rate limit {scope}={limit}")
+                changes.append((limiter, rate, burst))
+        for limiter, rate, burst in changes:
+            limiter.configure(rate, burst)
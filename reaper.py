@@ -0,0 +1,77 @@
+import threading
+import time
+from math import ceil
+
+# Seconds without hearing from a client before it is pinged, and before it is evicted
+DEFAULT_PING_INTERVAL = 30
+DEFAULT_IDLE_TIMEOUT = 300
+# Seconds between two turns of the timer wheel
+DEFAULT_TICK = 1
+
+
+class TimerWheel:
+    # A ring of slots, one per tick. An item is put in the slot of the tick it is
+    # due in and every tick takes out one whole slot, so scheduling and expiring
+    # are O(1) whatever the number of items. Items due later than one turn of
+    # the wheel are put in the last slot and have to be scheduled again.
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, item, delay):
+        ticks = min(max(1, ceil(delay / self.tick)), len(self.slots) - 1)
+        with self.lock:
+            self.slots[(self.current + ticks) % len(self.slots)].append(item)
+
+    def advance(self):
+        # Move on by one tick and return the items that are due
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            due = self.slots[self.current]
+            self.slots[self.current] = []
+        return due
+
+
+class Reaper:
+    # Watches the connections of a server on a timer wheel. A connection that
+    # has not sent anything for ping_interval seconds is pinged, and one that
+    # stays silent for idle_timeout seconds is evicted. Connections are only
+    # looked at when they are due, a busy one is just scheduled again.
+    def __init__(self, ping, evict, ping_interval=DEFAULT_PING_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 tick=DEFAULT_TICK):
+        self.ping = ping
+        self.evict = evict
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel(tick, ceil(max(ping_interval, idle_timeout) / tick) + 1)
+
+    def add(self, conn):
+        conn.last_seen = time.monotonic()
+        self.wheel.schedule(conn, min(self.ping_interval, self.idle_timeout))
+
+    def tick(self):
+        now = time.monotonic()
+        for conn in self.wheel.advance():
+            # Closed connections simply fall off the wheel
+            if conn.closed:
+                continue
+            idle = now - conn.last_seen
+            if idle >= self.idle_timeout:
+                self.evict(conn)
+                continue
+            if idle >= self.ping_interval:
+                self.ping(conn)
+                delay = min(self.ping_interval, self.idle_timeout - idle)
+            else:
+                delay = self.ping_interval - idle
+            self.wheel.schedule(conn, delay)
+
+    def run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            self.tick()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
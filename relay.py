@@ -0,0 +1,110 @@
+import argparse
+import logging
+import socket
+import threading
+
+from connection import DISCONNECT, SocketConnection
+from logs import LOG_LEVELS, setup_logging
+from protocol import RECV_SIZE, REQUEST, ProtocolError, encode_frame
+
+# Frames that may wait for a slow node. A node that falls further behind is
+# dropped, and syncs again when it reconnects.
+RELAY_QUEUE = 64 * 1024
+# Address of a frame for every other node
+BROADCAST = "*"
+
+log = logging.getLogger("chat.relay")
+
+
+class Relay:
+    # The message bus of a cluster of chat servers (see cluster.py). Every node
+    # keeps one framed connection to the relay and introduces itself with
+    # HELLO|node id, which the relay answers with NODES|the other node ids,
+    # oldest first. After that every frame is address|fields: the relay passes
+    # it on as sender|fields to the node with that id, or to every other node
+    # when the address is "*". Frames of one node reach the others in the order
+    # they were sent. The relay keeps nothing but the connections.
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sock.bind((host, port))
+        self.lock = threading.Lock()
+        # Node id -> connection, oldest first
+        self.nodes = {}
+
+    def start(self):
+        self.server_sock.listen()
+        log.info("Relay started on %s:%s", self.host, self.port)
+        while True:
+            node_sock, node_addr = self.server_sock.accept()
+            node_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.handle_node, args=(node_sock,), daemon=True).start()
+
+    def handle_node(self, node_sock):
+        node_conn = SocketConnection(node_sock, RELAY_QUEUE, DISCONNECT)
+        node = None
+        try:
+            while True:
+                data = node_sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                for kind, request_id, fields in node_conn.feed(data):
+                    if node is None:
+                        node = self.add_node(node_conn, fields)
+                    else:
+                        self.forward(node, fields)
+        except Exception as e:
+            log.warning("Node %s failed: %s", node, e)
+        node_conn.close()
+        if node is not None:
+            self.remove_node(node, node_conn)
+
+    def add_node(self, node_conn, fields):
+        if not node_conn.framed or fields[0] != "HELLO" or len(fields) < 2:
+            raise ProtocolError("A node has to start with HELLO")
+        node = str(fields[1])
+        with self.lock:
+            # A node that reconnects replaces its old connection
+            old_conn = self.nodes.pop(node, None)
+            others = list(self.nodes)
+            self.nodes[node] = node_conn
+        if old_conn is not None:
+            old_conn.close()
+        node_conn.send_frame(encode_frame(REQUEST, ["NODES", *others]))
+        log.info("Node %s joined, %s nodes in the cluster", node, len(others) + 1)
+        return node
+
+    def remove_node(self, node, node_conn):
+        with self.lock:
+            if self.nodes.get(node) is not node_conn:
+                return
+            del self.nodes[node]
+            count = len(self.nodes)
+        log.info("Node %s left, %s nodes in the cluster", node, count)
+
+    def forward(self, node, fields):
+        address = fields[0]
+        frame = encode_frame(REQUEST, [node, *fields[1:]])
+        with self.lock:
+            if address == BROADCAST:
+                targets = [conn for other, conn in self.nodes.items() if other != node]
+            else:
+                targets = [self.nodes[address]] if address in self.nodes else []
+        for target in targets:
+            try:
+                target.sendall(frame)
+            except ConnectionError:
+                # A node that does not keep up is dropped, its reader notices
+                pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Message relay between the nodes of a chat cluster")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    Relay(args.host, args.port).start()
@@ -1,30 +1,218 @@
+import argparse
+import asyncio
+import logging
 import socket
 import threading
+import time
 from datetime import datetime
 
+from auth import HASH_WORKERS, PasswordHasher
+from cluster import SYNC_CHUNK, ClusterLink
+from commands import REST, CommandRegistry, anything, count, load_plugins
+from connection import (BACKPRESSURE_POLICIES, DEFAULT_MAX_QUEUE, DROP_OLDEST, QueueStats,
+                        SocketConnection, StreamConnection)
+from directory import format_rooms, parse_options
+from history import DEFAULT_CAPACITY, DEFAULT_MAX_BYTES, RecentHistory
+from logs import LOG_LEVELS, setup_logging
+from message_log import MessageLog
+from metrics import SIZE_BUCKETS, Metrics, MetricsServer
+from protocol import DEFAULT_COMPRESS_THRESHOLD, RECV_SIZE, PreparedEvent, ZlibCodec
+from rate_limit import DEFAULT_CONNECTION_LIMIT, DEFAULT_ROOM_LIMIT, DEFAULT_USER_LIMIT, RateLimits, parse_limit
+from reaper import DEFAULT_IDLE_TIMEOUT, DEFAULT_PING_INTERVAL, Reaper
+from relay import BROADCAST
+from state import DEFAULT_INBOX, ChatState
+from state_store import DEFAULT_SNAPSHOT_INTERVAL, StateStore
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# How many messages of chatroom history are replayed on join and login
+DEFAULT_HISTORY = 20
+# Commands that keep a connection alive, they are never rate limited
+KEEPALIVE_COMMANDS = ("PING", "PONG")
+# Commands that send messages, limited per user as well, and chatroom messages per chatroom
+MESSAGE_COMMANDS = ("MESSAGE", "MULTI_MESSAGE", "DIRECT_MESSAGE")
+# Most commands a single BATCH may carry
+MAX_BATCH = 1000
+# Sent to framed clients that have been quiet, they answer with a PONG command
+PING_EVENT = PreparedEvent(["PING"])
+
+log = logging.getLogger("chat.server")
+
 class ChatServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_queue=DEFAULT_MAX_QUEUE, backpressure=DROP_OLDEST,
+                 log_dir=None, history=DEFAULT_HISTORY, history_buffer=DEFAULT_CAPACITY,
+                 history_memory=DEFAULT_MAX_BYTES, hash_workers=HASH_WORKERS, reuse_port=False,
+                 metrics_port=None, compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 ping_interval=DEFAULT_PING_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT, state_dir=None,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL, connection_limit=DEFAULT_CONNECTION_LIMIT,
+                 user_limit=DEFAULT_USER_LIMIT, room_limit=DEFAULT_ROOM_LIMIT, inbox_size=DEFAULT_INBOX, plugins=(),
+                 relay=None, node_id=None):
         self.host = host
         self.port = port
+        # Outbound queue size and what to do with clients that do not keep up
+        self.max_queue = max_queue
+        self.backpressure = backpressure
+        self.queue_stats = QueueStats()
+        # Offered to clients that ask for compression, None when compression is off
+        self.codec = ZlibCodec(compress_threshold) if compress_threshold is not None else None
+        # Pings quiet clients and evicts the ones that stay silent, off when idle_timeout is 0
+        self.reaper = Reaper(self.ping_connection, self.evict_connection, ping_interval,
+                             idle_timeout) if idle_timeout else None
+        # Token buckets per connection, user and chatroom, changed at runtime over the metrics port
+        self.limits = RateLimits(connection_limit, user_limit, room_limit)
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Lets several processes listen on the port, the kernel spreads the connections over them
+        if reuse_port:
+            self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_sock.bind((self.host, self.port))
 
-        # To keep track of the all the clients
-        self.clients = {}
-        # To keep track of the clients that are currently logged in
-        self.active_clients = []
-        # To keep track of the chatrooms
-        self.chatrooms = {}
-        # To keep track of the client sockets
-        self.clients_conn = {}
-        # To keep track of the client's chatroom
-        self.client_room = {}
+        # Users, chatrooms, memberships and client connections
+        self.state = ChatState()
+        # Users, chatrooms and memberships survive restarts when a state directory is given
+        self.store = StateStore(state_dir) if state_dir else None
+        if self.store is not None:
+            self.restore_state(snapshot_interval)
+        # Chatroom messages are kept on disk when a log directory is given
+        self.message_log = MessageLog(log_dir) if log_dir else None
+        # The latest messages of every chatroom are also kept in memory
+        self.recent = RecentHistory(history_buffer, history_memory)
+        self.history = history
+        # Direct messages kept for each user that is offline
+        self.inbox_size = inbox_size
+        # Passwords are hashed on a bounded pool of threads
+        self.hasher = PasswordHasher(hash_workers)
+        # Changes and chatroom messages are shared with the other servers of the cluster, when there is a relay
+        self.cluster = ClusterLink(relay, node_id or f"{host}:{port}", self.apply_remote,
+                                   self.cluster_joined) if relay else None
+        # Username -> id of the server the user last logged in on, when that is another one
+        self.homes = {}
+        # Username -> ids of the other servers the user is logged in on
+        self.online = {}
+
+        # Metrics, served over HTTP on localhost when a port is given
+        self.metrics_port = metrics_port
+        self.metrics = Metrics()
+        self.command_seconds = self.metrics.histogram(
+            "chat_command_seconds", "Time spent handling a command", ["command"])
+        self.fanout_connections = self.metrics.histogram(
+            "chat_fanout_connections", "Connections a chatroom message was queued for", buckets=SIZE_BUCKETS)
+        self.fanout_seconds = self.metrics.histogram(
+            "chat_fanout_seconds", "Time spent queueing a chatroom message for its members")
+        self.open_connections = self.metrics.gauge("chat_connections", "Open client connections")
+        self.accepted_connections = self.metrics.counter("chat_connections_total", "Client connections accepted")
+        self.pings_sent = self.metrics.counter("chat_pings_total", "Pings sent to quiet clients")
+        self.evicted_connections = self.metrics.counter(
+            "chat_evicted_connections_total", "Client connections evicted for being silent too long")
+        self.direct_messages = self.metrics.counter(
+            "chat_direct_messages_total", "Direct messages by whether they were delivered, held or refused",
+            ["outcome"])
+        self.rate_limited = self.metrics.counter(
+            "chat_rate_limited_total", "Commands and chatroom messages refused for going over a rate limit", ["scope"])
+        self.metrics.collect(self.collect_metrics)
+
+        # Command name -> handler and fields, each command is timed in command_seconds
+        self.commands = CommandRegistry(self.command_seconds)
+        self.register_commands()
+        load_plugins(self, plugins)
+
+    def restore_state(self, snapshot_interval):
+        # Load the users and chatrooms of the last run. The credentials are
+        # filled in on a thread while connections are already accepted, logins
+        # of restored users wait for them.
+        started = time.monotonic()
+        users, user_room, rooms, fill = self.store.load()
+        self.state.restore(users, user_room, rooms)
+        self.state.journal = self.store
+        self.state.credentials_loaded.clear()
+
+        def load_credentials():
+            fill(self.state.users)
+            self.state.credentials_loaded.set()
+            log.info("Loaded the credentials of %s users in %.2fs", len(users), time.monotonic() - started)
+
+        threading.Thread(target=load_credentials, daemon=True).start()
+        self.store.start(self.state.capture, snapshot_interval)
+        log.info("Restored %s users and %s chatrooms in %.2fs", len(users), len(rooms), time.monotonic() - started)
+
+    def collect_metrics(self):
+        # Values the server keeps anyway, read when the metrics are rendered
+        queues = self.queue_stats.snapshot()
+        return [
+            ("chat_queue_depth", "gauge", "Messages waiting in outbound queues", queues["depth"]),
+            ("chat_queue_max_depth", "gauge", "Deepest a single outbound queue has been", queues["max_depth"]),
+            ("chat_queue_queued_total", "counter", "Messages added to outbound queues", queues["queued"]),
+            ("chat_queue_sent_total", "counter", "Messages taken from outbound queues", queues["sent"]),
+            ("chat_queue_dropped_total", "counter", "Messages dropped from full queues", queues["dropped"]),
+            ("chat_queue_disconnected_total", "counter", "Clients disconnected for a full queue",
+             queues["disconnected"]),
+            ("chat_users", "gauge", "Registered users", len(self.state.users)),
+            ("chat_active_users", "gauge", "Logged in users", len(self.state.active_users)),
+            ("chat_rooms", "gauge", "Chatrooms", len(self.state.rooms)),
+            ("chat_cluster_published_total", "counter", "Changes and messages sent to the other servers",
+             self.cluster.published if self.cluster is not None else 0),
+            ("chat_cluster_received_total", "counter", "Changes and messages received from the other servers",
+             self.cluster.received if self.cluster is not None else 0),
+        ]
+
+    def start_metrics(self):
+        if self.metrics_port is not None:
+            MetricsServer(self.metrics, "127.0.0.1", self.metrics_port, self.limits).start()
+            log.info("Metrics on http://127.0.0.1:%s/metrics", self.metrics_port)
+
+    def start_reaper(self):
+        if self.reaper is not None:
+            self.reaper.start()
+
+    def start_cluster(self):
+        if self.cluster is not None:
+            self.cluster.start()
+
+    def publish(self, *fields):
+        # Tell the other servers of the cluster about a change, made here already
+        if self.cluster is not None:
+            self.cluster.publish(*fields)
+
+    def watch(self, client_conn):
+        # Let the reaper keep an eye on a new connection
+        if self.reaper is not None:
+            self.reaper.add(client_conn)
+
+    def ping_connection(self, client_conn):
+        # Only framed clients can tell a ping from a chatroom message
+        if client_conn.framed:
+            try:
+                client_conn.send_event(PING_EVENT)
+                self.pings_sent.inc()
+            except ConnectionError:
+                pass
+
+    def evict_connection(self, client_conn):
+        # The client stopped answering, most likely it is gone without closing the connection
+        log.info("Evicting silent connection of %s", client_conn.username or "an anonymous client")
+        self.evicted_connections.inc()
+        client_conn.close()
+        self.drop_connection(client_conn)
+
+    def drop_connection(self, client_conn, username=None):
+        # Forget a connection that is gone, by default for the user last logged
+        # in on it. The user is logged out, and leaves their chatroom, once they
+        # have no connection left.
+        if username is None:
+            username = client_conn.username
+        if username is not None and self.state.remove_connection(username, client_conn) == 0:
+            self.logout_user(username)
 
     def start(self):
         # Start listening for connections
         self.server_sock.listen()
-        print(f"Server started on {self.host}:{self.port}")
+        self.start_metrics()
+        self.start_reaper()
+        self.start_cluster()
+        log.info("Server started on %s:%s", self.host, self.port)
         # Start accepting connections
         while True:
             client_sock, client_addr = self.server_sock.accept()
@@ -32,252 +220,782 @@ class ChatServer:
             threading.Thread(target=self.handle_client, args=(client_sock,)).start()
 
     def handle_client(self, client_sock):
+        client_conn = SocketConnection(client_sock, self.max_queue, self.backpressure, self.queue_stats, self.codec)
+        self.accepted_connections.inc()
+        self.open_connections.inc()
+        self.watch(client_conn)
         # Keep listening for messages from the client
         while True:
             try:
                 # Receive message from client
-                data = client_sock.recv(1024).decode()
+                data = client_sock.recv(RECV_SIZE)
                 if not data:
                     break
-                data = data.split("|")
-                command = data[0]
-
-                # Handle the different commands
-                if command == "REGISTER":
-                    username = data[1]
-                    password = data[2]
-
-                    # Register the user
-                    if self.register_user(username, password) == "SUCCESS":
-                        self.clients_conn[username] = []
-                        self.clients_conn[username].append(client_sock)
-                        client_sock.sendall("SUCCESS".encode())
-                    else:
-                        client_sock.sendall("ERROR: Username already taken".encode())
-                
-                # Login the user
-                elif command == "LOGIN":
-                    username = data[1]
-                    password = data[2]
-                    message = self.login_user(username, password)
-                    if "SUCCESS" in message:
-                        self.clients_conn[username].append(client_sock)
-                        client_sock.sendall(message.encode())
-                    else:
-                        client_sock.sendall(message.encode())
-                        
-                # Logout the user 
-                elif command == "LOGOUT":
-                    username = data[1]
-                    if self.logout_user(username) == True:
-                        self.clients_conn[username].remove(client_sock)
-                        if len(self.clients_conn[username]) == 0:
-                            del self.clients_conn[username]
-                        client_sock.sendall("SUCCESS".encode())
-                    else:
-                        client_sock.sendall("ERROR: User not logged in".encode())
-
-                # Create a chatroom
-                elif command == "CREATE_CHATROOM":
-                    username = data[1]
-                    chatroom_name = data[2]
-                    message = self.create_chatroom(username,chatroom_name)
-                    client_sock.sendall(message.encode())
-
-                # Join a chatroom
-                elif command == "JOIN_CHATROOM":
-                    username = data[1]
-                    chatroom_name = data[2]
-                    message = self.join_chatroom(username, chatroom_name)
-                    client_sock.sendall(message.encode())
-
-                # Leave a chatroom
-                elif command == "LEAVE_CHATROOM":
-                    username = data[1]
-                    message = self.leave_chatroom(username)
-                    client_sock.sendall(message.encode())
-
-                # View all chatrooms
-                elif command == "VIEW_CHATROOMS":
-                    message = self.view_chatrooms()
-                    print(message)
-                    client_sock.sendall(message.encode())
-
-                # Send a message
-                elif command == "MESSAGE":
-                    username = data[1]
-                    message = data[2]
-                    if self.send_message(username, message) == "SUCCESS":
-                        client_sock.sendall("SUCCESS".encode())
-                    else:
-                        client_sock.sendall("ERROR: Message not sent".encode())
-
-                # View the current info of the user
-                elif command == "CURRENT_INFO":
-                    username = data[1]
-                    message = self.current_info(username)
-                    client_sock.sendall(message.encode())
-                
+                # A single read may carry several framed commands
+                for kind, request_id, fields in client_conn.feed(data):
+                    self.handle_command(client_conn, fields, request_id)
             except Exception as e:
-                print(e)
+                log.warning("Client connection failed: %s", e)
                 break
 
-        client_sock.close()
+        client_conn.close()
+        self.drop_connection(client_conn)
+        self.open_connections.dec()
+
+    def register_commands(self):
+        # Every command of the protocol with the fields it takes, plugins add theirs the same way
+        register = self.commands.register
+        register("REGISTER", self.on_register, ["username", "password"], blocking=True)
+        register("LOGIN", self.on_login, ["username", "password"], ["cursor"], blocking=True, types={"cursor": int})
+        register("LOGOUT", self.on_logout, ["username"])
+        register("CREATE_CHATROOM", self.on_create_chatroom, ["username", "chatroom_name"])
+        register("JOIN_CHATROOM", self.on_join_chatroom, ["username", "chatroom_name"], ["cursor"],
+                 types={"cursor": int})
+        register("LEAVE_CHATROOM", self.on_leave_chatroom, ["username"])
+        register("VIEW_CHATROOMS", self.on_view_chatrooms, rest=True)
+        register("MESSAGE", self.on_message, ["username", "message"])
+        register("MULTI_MESSAGE", self.on_multi_message, ["username", "message"], rest=True)
+        register("DIRECT_MESSAGE", self.on_direct_message, ["username", "recipient", "message"])
+        register("ROOM_MEMBERS", self.on_room_members, rest=True)
+        # A batch may contain commands that block
+        # The commands of a batch are checked when each one runs
+        register("BATCH", self.on_batch, rest=True, blocking=True, types={REST: anything})
+        register("HISTORY", self.on_history, ["username"], ["cursor", "limit"], types={"cursor": int, "limit": count})
+        register("PING", self.on_ping)
+        register("PONG", self.on_pong)
+        register("CURRENT_INFO", self.on_current_info, ["username"])
+
+    def handle_command(self, client_conn, data, request_id=0):
+        if not data:
+            self.commands.dispatch(client_conn, data, request_id)
+            return
+        started = time.perf_counter()
+        command = self.commands.get(data[0])
+        scope = self.over_limit(client_conn, data)
+        if scope is None:
+            self.commands.dispatch(client_conn, data, request_id, command)
+        else:
+            client_conn.send_reply(f"ERROR: Rate limit exceeded for {scope}", request_id)
+        seconds = command.seconds if command is not None else self.commands.unknown_seconds
+        seconds.observe(time.perf_counter() - started)
+
+    def over_limit(self, client_conn, data):
+        # The scope of the rate limit a command goes over, if any. Each check
+        # takes a token, so one that passes is spent even if a later one fails.
+        command = data[0]
+        if command in KEEPALIVE_COMMANDS:
+            return None
+        scope = None
+        if not self.limits.connection.allow(client_conn):
+            scope = "connection"
+        elif command in MESSAGE_COMMANDS and len(data) > 1:
+            # The user bucket is the one of whoever is logged in on the connection,
+            # not of the user the command names, which anybody can send
+            if not self.limits.user.allow(client_conn.username or client_conn):
+                scope = "user"
+            # The chatrooms of a MULTI_MESSAGE are checked one by one when it is posted
+            elif command == "MESSAGE":
+                chatroom_name = self.state.room_of(data[1])
+                if chatroom_name is not None and not self.limits.chatroom.allow(chatroom_name):
+                    scope = "chatroom"
+        if scope is not None:
+            self.rate_limited.labels(scope).inc()
+        return scope
+
+    def rooms_within_limit(self, chatroom_names):
+        # The chatrooms that may take one more message, each named once
+        allowed = []
+        for chatroom_name in dict.fromkeys(chatroom_names):
+            if self.limits.chatroom.allow(chatroom_name):
+                allowed.append(chatroom_name)
+            else:
+                self.rate_limited.labels("chatroom").inc()
+        return allowed
+
+    def on_register(self, client_conn, request_id, username, password):
+        if self.register_user(username, password) == "SUCCESS":
+            self.state.add_connection(username, client_conn)
+            client_conn.username = username
+            client_conn.send_reply("SUCCESS", request_id)
+        else:
+            client_conn.send_reply("ERROR: Username already taken", request_id)
+
+    def on_login(self, client_conn, request_id, username, password, cursor):
+        message = self.login_user(username, password)
+        if "SUCCESS" in message:
+            self.state.add_connection(username, client_conn)
+            client_conn.username = username
+            client_conn.send_reply(message, request_id)
+            # Catch the client up on their chatroom, then hand over the direct
+            # messages kept for them. Text clients leave those in the inbox, the
+            # text protocol cannot tell them apart from the reply.
+            chatroom_name = self.state.room_of(username)
+            if chatroom_name is not None:
+                self.replay_history(client_conn, chatroom_name, cursor)
+            if client_conn.framed:
+                for event in self.take_inbox(username):
+                    client_conn.send_event(event)
+        else:
+            client_conn.send_reply(message, request_id)
+
+    def on_logout(self, client_conn, request_id, username):
+        if self.logout_user(username) == True:
+            self.state.remove_connection(username, client_conn)
+            client_conn.username = None
+            client_conn.send_reply("SUCCESS", request_id)
+        else:
+            client_conn.send_reply("ERROR: User not logged in", request_id)
+
+    def on_create_chatroom(self, client_conn, request_id, username, chatroom_name):
+        client_conn.send_reply(self.create_chatroom(username, chatroom_name), request_id)
+
+    def on_join_chatroom(self, client_conn, request_id, username, chatroom_name, cursor):
+        message = self.join_chatroom(username, chatroom_name)
+        client_conn.send_reply(message, request_id)
+        if message == "SUCCESS":
+            self.replay_history(client_conn, chatroom_name, cursor)
+
+    def on_leave_chatroom(self, client_conn, request_id, username):
+        client_conn.send_reply(self.leave_chatroom(username), request_id)
+
+    def on_view_chatrooms(self, client_conn, request_id, *options):
+        # All chatrooms, a page of them or the ones changed since a version
+        client_conn.send_reply(self.view_chatrooms(options), request_id)
+
+    def on_message(self, client_conn, request_id, username, message):
+        if self.send_message(username, message) == "SUCCESS":
+            client_conn.send_reply("SUCCESS", request_id)
+        else:
+            client_conn.send_reply("ERROR: Message not sent", request_id)
+
+    def on_multi_message(self, client_conn, request_id, username, message, *chatroom_names):
+        # Post one message to several chatrooms, the ones over their rate limit are left out
+        if not self.state.is_registered(username):
+            client_conn.send_reply("Client not registered", request_id)
+        else:
+            posted = self.post_to_rooms(username, message, self.rooms_within_limit(chatroom_names))
+            client_conn.send_reply(f"SUCCESS|{posted}", request_id)
+
+    def on_direct_message(self, client_conn, request_id, username, recipient, message):
+        client_conn.send_reply(self.direct_message(username, recipient, message), request_id)
+
+    def on_room_members(self, client_conn, request_id, *chatroom_names):
+        client_conn.send_reply(self.format_listing(self.room_members(chatroom_names)), request_id)
+
+    def on_batch(self, client_conn, request_id, *fields):
+        self.run_batch(client_conn, fields, request_id)
+
+    def on_history(self, client_conn, request_id, username, cursor, limit):
+        # Catch up on the messages of the user's chatroom
+        self.send_history(client_conn, username, cursor, limit, request_id)
+
+    def on_ping(self, client_conn, request_id):
+        # A client checking that the server is alive
+        client_conn.send_reply("PONG", request_id)
+
+    def on_pong(self, client_conn, request_id):
+        # The answer to a ping, receiving it was all that mattered
+        pass
+
+    def on_current_info(self, client_conn, request_id, username):
+        client_conn.send_reply(self.current_info(username), request_id)
 
     def register_user(self, username, password):
-        # Check if username already exists
-        if username in self.clients.keys():
+        # Check if username already exists before paying for the hash
+        if self.state.is_registered(username):
+            return "ERROR: Username already taken"
+
+        # Register the user with a salted hash of the password, somebody may have taken the name meanwhile
+        credential = self.hasher.hash(password)
+        if not self.state.add_user(username, credential):
             return "ERROR: Username already taken"
 
-        # Register the user
-        self.clients[username] = password
-        self.active_clients.append(username)
-        print(f"Registered user {username} and joined into the system")
+        self.publish("USER", username, credential)
+        log.info("Registered user %s and joined into the system", username)
         return "SUCCESS"
 
     def login_user(self, username, password):
         # Check if username exists
-        if username not in self.clients:
+        if not self.state.is_registered(username):
             return "ERROR: Username does not exist"
         
         # Check if password is correct
-        print(self.clients[username], password)
-        if self.clients[username] != password:
+        if not self.hasher.verify(username, self.state.credential(username), password):
             return "ERROR: Incorrect password"
         
         # Login the user
-        self.active_clients.append(username)
-        print(f"Logged in user {username} and joined into the system")
-        if username in self.client_room:
-            return f"SUCCESS|{self.client_room[username]}"
+        self.state.activate(username)
+        self.homes.pop(username, None)
+        self.publish("ONLINE", username)
+        log.info("Logged in user %s and joined into the system", username)
+        chatroom_name = self.state.room_of(username)
+        if chatroom_name is not None:
+            return f"SUCCESS|{chatroom_name}"
         return "SUCCESS"
 
     def logout_user(self, username):
         # Check if username exists
-        if username not in self.clients:
+        if not self.state.is_registered(username):
             return False
         
-        # Remove the user from all chatrooms
-        for chatroom in self.chatrooms.keys():
-            if username in self.chatrooms[chatroom]:
-                self.chatrooms[chatroom].remove(username)
-        
-        # Logout the user
-        if username in self.client_room:
-            self.client_room.pop(username)
-        if username in self.active_clients:
-            self.active_clients.remove(username)
-        print(f"Logged out user {username} and left the system")
+        # Remove the user from their chatroom and logout the user, unless they
+        # are still logged in on another server of the cluster
+        others = self.online.get(username)
+        if others:
+            self.homes[username] = next(iter(others))
+        else:
+            self.state.deactivate(username)
+            self.homes.pop(username, None)
+        self.publish("OFFLINE", username)
+        log.info("Logged out user %s and left the system", username)
         return True
 
     def create_chatroom(self, username, chatroom_name):
         # Check if username exists
-        if username not in self.clients:
-            print(f"Client {username} not registered")
+        if not self.state.is_registered(username):
+            log.debug("Client %s not registered", username)
             return "Client not registered"
         # Check if chatroom already exists
-        elif chatroom_name in self.chatrooms:
-            print(f"Chatroom {chatroom_name} already exists")
+        elif self.state.has_room(chatroom_name):
+            log.debug("Chatroom %s already exists", chatroom_name)
             return "Chatroom already exists"
         # Check if client is already in another chatroom
-        elif username in self.client_room.keys():
-            print(f"Client {username} already in another chatroom")
+        elif self.state.room_of(username) is not None:
+            log.debug("Client %s already in another chatroom", username)
             return "Client already in another chatroom"
         else:
-            # Create the chatroom
-            self.chatrooms[chatroom_name] = []
-            self.client_room[username] = chatroom_name
-            self.chatrooms[chatroom_name].append(username)
-            print(f"Client {username} created chatroom {chatroom_name}")
+            # Create the chatroom, another client may have been faster
+            if not self.state.create_room(username, chatroom_name):
+                log.debug("Chatroom %s already exists", chatroom_name)
+                return "Chatroom already exists"
+            self.publish("JOIN", username, chatroom_name)
+            log.info("Client %s created chatroom %s", username, chatroom_name)
             return "SUCCESS"
 
     def join_chatroom(self, username, chatroom_name):
         # Check if username exists
-        if username not in self.clients:
-            print(f"Username {username} not registered")
+        if not self.state.is_registered(username):
+            log.debug("Username %s not registered", username)
             return "Client not registered"
         # Check if chatroom exists
-        elif chatroom_name not in self.chatrooms:
-            print(f"Chatroom {chatroom_name} does not exist")
+        elif not self.state.has_room(chatroom_name):
+            log.debug("Chatroom %s does not exist", chatroom_name)
             return "Chatroom does not exist"
         else:
-            # Check if client is already in another chatroom
-            for chatroom in self.chatrooms.keys():
-                if username in self.chatrooms[chatroom]:
-                    self.client_room.pop(username)
-                    self.chatrooms[chatroom].remove(username)
-                    print(f"Client {username} left chatroom {chatroom}")
-            # Join the chatroom
-            self.client_room[username] = chatroom_name
-            self.chatrooms[chatroom_name].append(username)
-            print(f"Client {username} joined chatroom {chatroom_name}")
+            # Join the chatroom, leaving the one the client is in
+            old_room = self.state.join_room(username, chatroom_name)
+            self.publish("JOIN", username, chatroom_name)
+            if old_room is not None:
+                log.info("Client %s left chatroom %s", username, old_room)
+            log.info("Client %s joined chatroom %s", username, chatroom_name)
             return "SUCCESS"
 
     def leave_chatroom(self, username):
-        # Check if username exists
-        chatroom_name = self.client_room[username]
-        # Check if chatroom exists
-        if chatroom_name not in self.chatrooms:
-            print(f"Chatroom {chatroom_name} does not exist")
-            return "Chatroom does not exist"
-        # Check if username is in chatroom
-        if username not in self.chatrooms[chatroom_name]:
-            print(f"Username {username} not in chatroom")
+        # Check if username is in a chatroom
+        chatroom_name = self.state.leave_room(username)
+        if chatroom_name is None:
+            log.debug("Username %s not in chatroom", username)
             return "Client not in chatroom"
 
-        # Remove all instances of username from chatroom
-        self.client_room.pop(username)
-        self.chatrooms[chatroom_name].remove(username)
-        print(f"Client {username} left chatroom {chatroom_name}")
+        self.publish("LEAVE", username)
+        log.info("Client %s left chatroom %s", username, chatroom_name)
         return "SUCCESS"
 
-    def view_chatrooms(self):
-        message = ""
-        # In the format chatroom_name|username1,username2,username3\n
-        for chatroom_name in self.chatrooms.keys():
-            message += chatroom_name + "|"
-            for username in self.chatrooms[chatroom_name]:
-                message += username + ","
-            message = message[:-1] + "\n"
-        return message
+    def view_chatrooms(self, options=()):
+        # Without options every chatroom, in the format chatroom_name|username1,username2\n.
+        # With key=value options the listing starts with SUCCESS|version|cursor:
+        #   prefix=  only chatrooms whose name starts with it
+        #   after=   the cursor of the previous page, limit= chatrooms per page
+        #   counts=1 chatroom_name|member count instead of the members
+        #   since=   only the chatrooms changed after that version, the cursor is
+        #            DELTA, or FULL when the version is too old and all are sent
+        if not options:
+            return self.full_listing()
+        options = parse_options(options)
+        prefix = options.get("prefix", "")
+        counts = options.get("counts", "0") != "0"
+        if "since" in options:
+            version, listing = self.directory_changes(options["since"], prefix)
+            if listing is not None:
+                return f"SUCCESS|{version}|DELTA\n" + format_rooms(listing, counts)
+            version, listing, more = self.directory_page(prefix, "", None)
+            return f"SUCCESS|{version}|FULL\n" + format_rooms(listing, counts)
+        limit = options.get("limit")
+        if limit is not None:
+            if not limit.isdigit() or int(limit) == 0:
+                return "ERROR: Invalid limit"
+            limit = int(limit)
+        version, listing, more = self.directory_page(prefix, options.get("after", ""), limit)
+        cursor = listing[-1][0] if more else ""
+        return f"SUCCESS|{version}|{cursor}\n" + format_rooms(listing, counts)
+
+    def full_listing(self):
+        # Made once per version of the directory
+        return self.state.directory.current().full_listing()
+
+    def format_listing(self, listing):
+        return format_rooms(listing)
+
+    def room_listing(self):
+        # Every chatroom with its members, sorted by name
+        return self.state.directory.current().rooms
+
+    def directory_page(self, prefix, after, limit):
+        # The version, up to limit chatrooms after the cursor and whether more follow
+        return self.state.directory.page(prefix, after, limit)
+
+    def directory_changes(self, since, prefix):
+        # The version and the chatrooms changed since the given one, None if it is too old
+        if not since.isdigit():
+            return self.state.directory.version, None
+        return self.state.directory.since_rooms(int(since), prefix)
 
+    def room_members(self, chatroom_names):
+        # The chatrooms that exist out of the given ones, with their members
+        return [(chatroom_name, self.state.members(chatroom_name))
+                for chatroom_name in chatroom_names if self.state.has_room(chatroom_name)]
+
+    def run_batch(self, client_conn, data, request_id):
+        # The commands come one after the other, each as its number of fields and the fields
+        commands = []
+        index = 0
+        try:
+            while index < len(data):
+                count = int(data[index])
+                fields = list(data[index + 1:index + 1 + count])
+                if count < 1 or len(fields) < count:
+                    raise ValueError
+                commands.append(fields)
+                index += 1 + count
+        except ValueError:
+            client_conn.send_reply("ERROR: Malformed batch", request_id)
+            return
+        if len(commands) > MAX_BATCH:
+            client_conn.send_reply(f"ERROR: A batch may have at most {MAX_BATCH} commands", request_id)
+            return
+        if any(fields[0] == "BATCH" for fields in commands):
+            client_conn.send_reply("ERROR: Batches cannot be nested", request_id)
+            return
+
+        # Run the commands in order, keeping their replies for a single answer.
+        # Chatroom messages they cause are sent as usual.
+        client_conn.replies = []
+        try:
+            for fields in commands:
+                replies = len(client_conn.replies)
+                try:
+                    self.handle_command(client_conn, fields)
+                except (IndexError, ValueError):
+                    del client_conn.replies[replies:]
+                    client_conn.replies.append("ERROR: Malformed command")
+            replies = client_conn.replies
+        finally:
+            client_conn.replies = None
+        client_conn.send_reply_fields([f"SUCCESS|{len(replies)}"] + replies, request_id)
 
     def send_message(self, username, message):
         # Check if username exists
-        if username not in self.clients:
-            print(f"Username {username} not registered")
+        if not self.state.is_registered(username):
+            log.debug("Username %s not registered", username)
             return "Client not registered"
         # Check if username is in chatroom
-        if username not in self.client_room:
-            print(f"Username {username} not in chatroom")
+        chatroom_name = self.state.room_of(username)
+        if chatroom_name is None:
+            log.debug("Username %s not in chatroom", username)
             return "Client not in chatroom"
 
-        chatroom_name = self.client_room[username]
-        for client in self.chatrooms[chatroom_name]:
+        self.post_message(username, message, chatroom_name)
+        return "SUCCESS"
+
+    def direct_message(self, username, recipient, message):
+        # Send a message to every connection of one user, or keep it in their
+        # inbox while they have none. Replies SUCCESS with the number of
+        # connections it went to, 0 when it was kept.
+        if not self.state.is_registered(username):
+            return "ERROR: Client not registered"
+        if not self.state.is_registered(recipient):
+            return "ERROR: Recipient does not exist"
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        sent = self.deliver_direct(recipient, PreparedEvent(["DIRECT_MESSAGE", timestamp, username, message]))
+        if sent is None:
+            self.direct_messages.labels("refused").inc()
+            return "ERROR: Inbox of the recipient is full"
+        self.direct_messages.labels("delivered" if sent else "held").inc()
+        log.debug("Direct message sent by %s to %s", username, recipient)
+        return f"SUCCESS|{sent}"
+
+    def deliver_direct(self, recipient, event):
+        # Returns how many connections the message went to, 0 if it went to the
+        # inbox and None if that is full. Found through the user's connections,
+        # whatever the number of users and chatrooms.
+        home = self.homes.get(recipient)
+        if home is not None:
+            # The user last logged in on another server of the cluster, which
+            # sends it to its connections or keeps it. That counts as one.
+            self.cluster.send(home, "DIRECT", recipient, *event.fields)
+            return max(1, self.send_direct(event, self.state.connections(recipient)))
+        conns = self.state.connections_or_hold(recipient, event, self.inbox_size)
+        if conns is None:
+            return None
+        sent = self.send_direct(event, conns)
+        # Every connection was gone, keep the message after all
+        if conns and not sent and not self.state.hold(recipient, event, self.inbox_size):
+            return None
+        if not sent:
+            # Whichever server the user logs in on next hands it over
+            self.publish("HOLD", recipient, *event.fields)
+        return sent
+
+    def send_direct(self, event, conns):
+        sent = 0
+        for conn in conns:
+            try:
+                conn.send_event(event)
+                sent += 1
+            except ConnectionError:
+                pass
+        return sent
+
+    def take_inbox(self, username):
+        events = self.state.take_inbox(username)
+        # The other servers of the cluster drop their copies
+        if events:
+            self.publish("TAKEN", username)
+        return events
+
+    def post_to_rooms(self, username, message, chatroom_names):
+        # Post a message to every chatroom that exists out of the given ones,
+        # returns how many that were
+        posted = 0
+        for chatroom_name in dict.fromkeys(chatroom_names):
+            if self.state.has_room(chatroom_name):
+                self.post_message(username, message, chatroom_name)
+                posted += 1
+        return posted
+
+    def post_message(self, username, message, chatroom_name):
+        # Members on the other servers of the cluster get it from their own server
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.publish("POST", chatroom_name, timestamp, username, message)
+        self.broadcast(username, message, chatroom_name, timestamp)
+
+    def broadcast(self, username, message, chatroom_name, timestamp):
+        # Log the message, its sequence number lets clients catch up later. It
+        # is numbered and buffered under the room lock, so the buffer of the
+        # room holds its messages in order.
+        with self.state.room_lock(chatroom_name):
+            if self.message_log is not None:
+                seq = self.message_log.append(chatroom_name, timestamp, username, message)
+            else:
+                seq = self.state.next_seq(chatroom_name)
+            # Format and encode the message once, every member gets the same bytes and timestamp
+            event = PreparedEvent(["MESSAGE", timestamp, username, message, chatroom_name, seq])
+            self.recent.add(chatroom_name, seq, event)
+        started = time.perf_counter()
+        sent = 0
+        disconnected = []
+        for client in self.state.members(chatroom_name):
             # In the format [datetime] username: message
-            for client_ind_conn in self.clients_conn[client]:
+            for client_ind_conn in self.state.connections(client):
                 try:
-                    client_ind_conn.sendall(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {username}: {message}".encode())
+                    client_ind_conn.send_event(event)
+                    sent += 1
                 except:
-                    print(f"Client {client} disconnected")
-                    self.clients_conn[client].remove(client_ind_conn)
-                    self.logout_user(client)
-                    continue
+                    disconnected.append((client, client_ind_conn))
+        self.fanout_seconds.observe(time.perf_counter() - started)
+        self.fanout_connections.observe(sent)
+
+        # Clean up after the loop, the memberships cannot change while iterating them
+        for client, client_ind_conn in disconnected:
+            log.info("Client %s disconnected", client)
+            # The connection may have moved on to another user since
+            self.drop_connection(client_ind_conn, client)
                 
-        print(f"Message sent by {username} in chatroom {chatroom_name}")
-        return "SUCCESS"
+        log.debug("Message sent by %s in chatroom %s", username, chatroom_name)
+
+    def read_history(self, chatroom_name, cursor=None, limit=None):
+        # The messages after the cursor, or the latest ones without a cursor.
+        # They come from memory when possible and from the message log otherwise.
+        since = int(cursor) if cursor not in (None, "") else None
+        limit = min(int(limit), max(self.recent.capacity, self.history)) if limit not in (None, "") else self.history
+        events = self.recent.get(chatroom_name, since, limit)
+        if events is None and self.message_log is not None:
+            events = [PreparedEvent(["MESSAGE", timestamp, username, message, chatroom_name, seq])
+                      for seq, timestamp, username, message in self.message_log.read(chatroom_name, since, limit)]
+        return events or []
+
+    def replay_history(self, client_conn, chatroom_name, cursor=None):
+        # Text clients only get the history when they ask with a cursor, because
+        # the text protocol cannot tell it apart from the reply
+        if cursor in (None, "") and not client_conn.framed:
+            return
+        for event in self.read_history(chatroom_name, cursor):
+            client_conn.send_event(event)
+
+    def send_history(self, client_conn, username, cursor, limit, request_id):
+        # Reply with the number of messages, then send them
+        chatroom_name = self.state.room_of(username)
+        if chatroom_name is None:
+            client_conn.send_reply("ERROR: Client not in chatroom", request_id)
+            return
+        events = self.read_history(chatroom_name, cursor, limit)
+        if client_conn.framed:
+            client_conn.send_reply(f"SUCCESS|{len(events)}", request_id)
+            for event in events:
+                client_conn.send_event(event)
+        else:
+            # The text protocol gets everything in the reply, one message per line
+            lines = [event.encoded(False).decode() for event in events]
+            client_conn.send_reply("\n".join([f"SUCCESS|{len(events)}"] + lines), request_id)
 
     def current_info(self, username):
-        # Check if username exists
-        if username not in self.client_room.keys():
-            return "ERROR: Client not in chatroom"
         # Check if username is in chatroom
-        chatroom_name = self.client_room[username]
+        chatroom_name = self.state.room_of(username)
+        if chatroom_name is None:
+            return "ERROR: Client not in chatroom"
         return f"SUCCESS|{chatroom_name}"
 
+    def apply_remote(self, node, fields):
+        # A change another server of the cluster made and published, or its
+        # request for the state of this one. Applied without publishing it again.
+        change = fields[0]
+        if change == "POST":
+            chatroom_name, timestamp, username, message = fields[1:5]
+            if self.state.has_room(chatroom_name):
+                self.broadcast(username, message, chatroom_name, timestamp)
+        elif change == "USER":
+            # Registering logs the user in
+            if self.state.add_user(fields[1], fields[2]):
+                self.node_online(fields[1], node)
+        elif change == "ONLINE":
+            self.state.activate(fields[1])
+            self.node_online(fields[1], node)
+        elif change == "OFFLINE":
+            # Logged out there, the user may still be logged in here or elsewhere
+            if not self.node_offline(fields[1], node) and not self.state.connections(fields[1]):
+                self.state.deactivate(fields[1])
+        elif change == "JOIN":
+            self.apply_join(fields[1], fields[2])
+        elif change == "LEAVE":
+            self.state.leave_room(fields[1])
+        elif change == "DIRECT":
+            self.deliver_direct(fields[1], PreparedEvent(fields[2:]))
+        elif change == "HOLD":
+            self.state.hold(fields[1], PreparedEvent(fields[2:]), self.inbox_size)
+        elif change == "TAKEN":
+            self.state.take_inbox(fields[1])
+        elif change == "SYNC":
+            self.send_state(node)
+        elif change == "ROOMS":
+            for chatroom_name in fields[1:]:
+                self.state.add_room(chatroom_name)
+        elif change == "STATE":
+            self.apply_state(fields[1:])
+        else:
+            log.warning("Unknown change %s from node %s", change, node)
+
+    def cluster_joined(self, others):
+        # What changed here while the relay was out of reach is news to the others
+        if others:
+            self.send_state(BROADCAST)
+
+    def node_online(self, username, node):
+        self.online.setdefault(username, set()).add(node)
+        self.homes[username] = node
+
+    def node_offline(self, username, node):
+        # Returns whether the user is still logged in on another server
+        nodes = self.online.get(username, set())
+        nodes.discard(node)
+        if not nodes:
+            self.online.pop(username, None)
+        # Direct messages go to another server the user is on, or stay here
+        if self.homes.get(username) == node:
+            if nodes:
+                self.homes[username] = next(iter(nodes))
+            else:
+                self.homes.pop(username, None)
+        return bool(nodes)
+
+    def apply_join(self, username, chatroom_name):
+        # Another server may have created the chatroom
+        self.state.add_room(chatroom_name)
+        self.state.join_room(username, chatroom_name)
+
+    def send_state(self, node):
+        # Every chatroom, then every user as username, credential, the server
+        # they are logged in on and their chatroom, in frames of SYNC_CHUNK at most
+        users, user_room, rooms = self.state.capture()
+        for index in range(0, len(rooms), SYNC_CHUNK):
+            self.cluster.send(node, "ROOMS", *rooms[index:index + SYNC_CHUNK])
+        names = list(users)
+        for index in range(0, len(names), SYNC_CHUNK):
+            fields = []
+            for username in names[index:index + SYNC_CHUNK]:
+                home = self.homes.get(username, self.cluster.node_id) if username in self.state.active_users else ""
+                fields += [username, users[username], home, user_room.get(username, "")]
+            self.cluster.send(node, "STATE", *fields)
+        log.info("Sent %s users and %s chatrooms to node %s", len(names), len(rooms), node)
+
+    def apply_state(self, fields):
+        # Merged into what this server knows: users it has not heard of are
+        # added, logins and chatrooms taken over. Nobody is logged out or taken
+        # out of a chatroom, the other server may just not have heard of it.
+        for index in range(0, len(fields) - 3, 4):
+            username, credential, home, chatroom_name = fields[index:index + 4]
+            self.state.add_user(username, credential)
+            if home:
+                self.state.activate(username)
+                if home != self.cluster.node_id:
+                    self.node_online(username, home)
+            if chatroom_name:
+                self.apply_join(username, chatroom_name)
+
+
+class AsyncChatServer(ChatServer):
+    # Size of the per-connection read buffer of the stream reader
+    READ_LIMIT = 16 * 1024
+
+    def start(self):
+        # Allow as many open sockets as the hard limit permits
+        if resource is not None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        asyncio.run(self.serve())
+
+    def start_reaper(self):
+        # Connections may only be closed from the event loop, so the wheel turns there
+        if self.reaper is not None:
+            asyncio.ensure_future(self.reap())
+
+    async def reap(self):
+        while True:
+            await asyncio.sleep(self.reaper.wheel.tick)
+            self.reaper.tick()
+
+    def start_cluster(self):
+        # Changes of the other servers are applied on the event loop, where
+        # chatroom messages are written to the connections without a hand-over
+        if self.cluster is not None:
+            loop = asyncio.get_running_loop()
+            self.cluster.apply = lambda node, fields: loop.call_soon_threadsafe(self.apply_remote, node, fields)
+        super().start_cluster()
+
+    async def serve(self):
+        # Start listening for connections on the already bound socket
+        self.server_sock.listen(socket.SOMAXCONN)
+        self.server_sock.setblocking(False)
+        self.start_metrics()
+        self.start_reaper()
+        self.start_cluster()
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_sock, limit=self.READ_LIMIT)
+        log.info("Server started on %s:%s (asyncio)", self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client_async(self, reader, writer):
+        # One coroutine per connection, all running on a single event loop
+        client_conn = StreamConnection(writer, self.max_queue, self.backpressure, self.queue_stats, self.codec)
+        self.accepted_connections.inc()
+        self.open_connections.inc()
+        self.watch(client_conn)
+        while True:
+            try:
+                # Receive message from client
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                # A single read may carry several framed commands
+                for kind, request_id, fields in client_conn.feed(data):
+                    # Commands that may block, such as on password hashing, run on a thread
+                    if fields and self.commands.is_blocking(fields[0]):
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self.handle_command, client_conn, fields, request_id)
+                    else:
+                        self.handle_command(client_conn, fields, request_id)
+            except Exception as e:
+                log.warning("Client connection failed: %s", e)
+                break
+
+        client_conn.close()
+        self.drop_connection(client_conn)
+        self.open_connections.dec()
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--mode", choices=["threaded", "async", "sharded"], default="threaded",
+                        help="threaded: one thread per connection, async: one asyncio event loop, "
+                             "sharded: chatrooms spread over worker processes")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes in sharded mode, defaults to the number of cores")
+    parser.add_argument("--max-queue", type=int, default=DEFAULT_MAX_QUEUE,
+                        help="outgoing messages that may wait for a slow client")
+    parser.add_argument("--backpressure", choices=BACKPRESSURE_POLICIES, default=DROP_OLDEST,
+                        help="drop the oldest waiting message or disconnect the client when its queue is full")
+    parser.add_argument("--log-dir", default="chat_log",
+                        help="directory of the chatroom message log, empty to keep no log")
+    parser.add_argument("--state-dir", default="chat_state",
+                        help="directory where users and chatrooms are kept across restarts, empty to keep none")
+    parser.add_argument("--snapshot-interval", type=float, default=DEFAULT_SNAPSHOT_INTERVAL,
+                        help="seconds between snapshots of the users and chatrooms")
+    parser.add_argument("--history", type=int, default=DEFAULT_HISTORY,
+                        help="messages replayed when a client joins a chatroom or logs in")
+    parser.add_argument("--history-buffer", type=int, default=DEFAULT_CAPACITY,
+                        help="latest messages kept in memory per chatroom, 0 keeps none")
+    parser.add_argument("--hash-workers", type=int, default=HASH_WORKERS,
+                        help="threads that hash passwords")
+    parser.add_argument("--history-memory", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="megabytes of recent messages kept in memory over all chatrooms")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics over HTTP on this localhost port, sharded workers use the following ports")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO")
+    parser.add_argument("--compress-threshold", type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+                        help="smallest frame in bytes that is compressed for clients that ask for compression")
+    parser.add_argument("--no-compression", action="store_true", help="never compress, even if clients ask")
+    parser.add_argument("--ping-interval", type=float, default=DEFAULT_PING_INTERVAL,
+                        help="seconds a client may be quiet before it is pinged")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="seconds a client may be silent before its connection is closed, 0 never closes")
+    parser.add_argument("--connection-limit", type=parse_limit, default=DEFAULT_CONNECTION_LIMIT,
+                        help="commands per second a connection may send, as RATE/BURST, 0 for no limit")
+    parser.add_argument("--user-limit", type=parse_limit, default=DEFAULT_USER_LIMIT,
+                        help="chatroom messages per second a user may send, as RATE/BURST, 0 for no limit")
+    parser.add_argument("--room-limit", type=parse_limit, default=DEFAULT_ROOM_LIMIT,
+                        help="messages per second a chatroom may take, as RATE/BURST, 0 for no limit")
+    parser.add_argument("--inbox-size", type=int, default=DEFAULT_INBOX,
+                        help="direct messages kept for a user while they are offline")
+    parser.add_argument("--plugin", action="append", default=[], dest="plugins",
+                        help="module whose register(server) function adds commands, may be given several times")
+    parser.add_argument("--relay", default=None,
+                        help="HOST:PORT of the relay (relay.py) that links the servers of a cluster")
+    parser.add_argument("--node-id", default=None,
+                        help="name of this server in the cluster, HOST:PORT of the server by default")
+    args = parser.parse_args()
+    if args.max_queue < 1:
+        parser.error("--max-queue must be at least 1")
+    if args.relay and args.mode == "sharded":
+        parser.error("--relay is not supported in sharded mode")
+    setup_logging(args.log_level)
+
     # Create the chat server
-    chat_server = ChatServer('127.0.0.1', 5000)
+    options = dict(max_queue=args.max_queue, backpressure=args.backpressure, log_dir=args.log_dir,
+                   history=args.history, history_buffer=args.history_buffer,
+                   history_memory=args.history_memory * 1024 * 1024, hash_workers=args.hash_workers,
+                   metrics_port=args.metrics_port,
+                   compress_threshold=None if args.no_compression else args.compress_threshold,
+                   ping_interval=args.ping_interval, idle_timeout=args.idle_timeout, state_dir=args.state_dir,
+                   snapshot_interval=args.snapshot_interval, connection_limit=args.connection_limit,
+                   user_limit=args.user_limit, room_limit=args.room_limit, inbox_size=args.inbox_size,
+                   plugins=args.plugins, relay=args.relay, node_id=args.node_id)
+    if args.mode == "sharded":
+        from sharding import ShardedChatServer
+        chat_server = ShardedChatServer(args.host, args.port, args.workers, log_level=args.log_level, **options)
+    else:
+        server_class = AsyncChatServer if args.mode == "async" else ChatServer
+        chat_server = server_class(args.host, args.port, **options)
     # Start the chat server
     chat_server.start()
\ No newline at end of file
@@ -0,0 +1,548 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import zlib
+from collections import deque
+
+from connection import SocketConnection
+from directory import format_rooms
+from ipc import IpcClient, IpcServer
+from logs import setup_logging
+from protocol import RECV_SIZE, FrameDecoder, PreparedEvent, TextDecoder, encode_frame
+from server import ChatServer
+from state_store import DEFAULT_SNAPSHOT_INTERVAL, StateStore
+
+# Commands that act on the chatroom named in the command
+ROOM_COMMANDS = ("CREATE_CHATROOM", "JOIN_CHATROOM")
+# Commands that act on the chatroom the user is in
+MEMBER_COMMANDS = ("MESSAGE", "LEAVE_CHATROOM", "HISTORY")
+# Fields of a direct message event: DIRECT_MESSAGE, timestamp, sender, message
+DIRECT_FIELDS = 4
+
+log = logging.getLogger("chat.sharding")
+
+
+def shard_of(chatroom_name, shards):
+    # The shard that owns a chatroom, the same in every process
+    return zlib.crc32(chatroom_name.encode()) % shards
+
+
+def coordinator_path(socket_dir):
+    return os.path.join(socket_dir, "coordinator.sock")
+
+
+def shard_path(socket_dir, shard):
+    return os.path.join(socket_dir, f"shard-{shard}.sock")
+
+
+class Coordinator:
+    # Keeps what every shard needs to agree on: the registered users and the
+    # chatroom each user is in. It only answers small lookups, the messages
+    # themselves never pass through it. Kept on disk when a state directory is
+    # given. It also keeps the direct messages of users with no connection, in memory.
+    def __init__(self, path, state_dir=None, snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        self.lock = threading.Lock()
+        # Username -> stored credential
+        self.users = {}
+        # Username -> name of the chatroom the user is in
+        self.user_room = {}
+        # Username -> fields of the direct messages waiting for the user
+        self.inboxes = {}
+        self.server = IpcServer(path, self.handle)
+        self.store = StateStore(state_dir) if state_dir else None
+        self.snapshot_interval = snapshot_interval
+        if self.store is not None:
+            # Every lookup needs the credentials, they are loaded right away
+            self.users, self.user_room, rooms, fill = self.store.load()
+            fill(self.users)
+
+    def start(self):
+        self.server.start()
+        if self.store is not None:
+            self.store.start(self.capture, self.snapshot_interval)
+
+    def capture(self):
+        with self.lock:
+            return dict(self.users), dict(self.user_room), []
+
+    def record(self, *fields):
+        if self.store is not None:
+            self.store.record(*fields)
+
+    def handle(self, fields, fds):
+        command, username = fields[0], fields[1]
+        with self.lock:
+            if command == "LOOKUP":
+                return [self.users.get(username, "")]
+            elif command == "REGISTER":
+                if username in self.users:
+                    return ["ERROR: Username already taken"]
+                self.users[username] = fields[2]
+                self.record("USER", username, fields[2])
+                return ["SUCCESS"]
+            elif command == "ROOM":
+                return [self.user_room.get(username, "")]
+            # Put a user that is in no chatroom into a new one
+            elif command == "CLAIM":
+                if username in self.user_room:
+                    return ["Client already in another chatroom"]
+                self.user_room[username] = fields[2]
+                self.record("JOIN", username, fields[2])
+                return ["SUCCESS"]
+            # Move a user to a chatroom, returns the one they were in
+            elif command == "MOVE":
+                old_room = self.user_room.get(username, "")
+                self.user_room[username] = fields[2]
+                self.record("JOIN", username, fields[2])
+                return [old_room]
+            # Take a user out of their chatroom, returns the one they were in
+            elif command == "CLEAR":
+                old_room = self.user_room.pop(username, "")
+                if old_room:
+                    self.record("LEAVE", username)
+                return [old_room]
+            # Keep a direct message for a user with no connection on any shard
+            elif command == "HOLD":
+                inbox = self.inboxes.setdefault(username, deque())
+                if len(inbox) >= fields[2]:
+                    return ["ERROR: Inbox of the recipient is full"]
+                inbox.append(fields[3:])
+                return ["SUCCESS"]
+            # Take the direct messages kept for a user, one after the other
+            elif command == "INBOX":
+                return [field for event in self.inboxes.pop(username, ()) for field in event]
+        return [f"ERROR: Unknown command {command}"]
+
+
+class ShardWorker(ChatServer):
+    # One process of a sharded server. It owns the chatrooms that hash to its
+    # shard, together with their logs and history, and serves the connections
+    # of the users in those chatrooms, so a broadcast never leaves the process.
+    #
+    # All workers accept on the same port. A connection that sends a command
+    # for a chatroom of another shard is handed over to that shard with its
+    # socket, the commands it has pipelined and the bytes not yet decoded.
+    # Users and the chatroom each one is in are kept by the coordinator.
+    def __init__(self, shard, shards, socket_dir, host, port, **options):
+        super().__init__(host, port, reuse_port=True, **options)
+        self.shard = shard
+        self.shards = shards
+        self.coordinator = IpcClient(coordinator_path(socket_dir))
+        self.peers = [IpcClient(shard_path(socket_dir, i)) for i in range(shards)]
+        self.control = IpcServer(shard_path(socket_dir, shard), self.handle_control)
+
+    def start(self):
+        self.control.start()
+        super().start()
+
+    def owner(self, chatroom_name):
+        return shard_of(chatroom_name, self.shards)
+
+    def handle_client(self, client_sock):
+        client_conn = SocketConnection(client_sock, self.max_queue, self.backpressure, self.queue_stats, self.codec)
+        self.accepted_connections.inc()
+        self.open_connections.inc()
+        self.watch(client_conn)
+        self.serve_client(client_conn, [])
+
+    def serve_client(self, client_conn, commands):
+        # Like ChatServer.handle_client, but hands the connection over to
+        # another shard as soon as a command belongs there
+        commands = deque(commands)
+        while True:
+            try:
+                while commands:
+                    kind, request_id, fields = commands.popleft()
+                    shard = self.route(fields)
+                    if shard != self.shard:
+                        commands.appendleft((kind, request_id, fields))
+                        self.hand_off(client_conn, shard, commands)
+                        return
+                    self.handle_command(client_conn, fields, request_id)
+                    # After a login the connection belongs with the user's chatroom
+                    if fields[:1] == ["LOGIN"] and client_conn.username == fields[1]:
+                        chatroom_name = self.coordinator.call("ROOM", fields[1])[0]
+                        if chatroom_name and self.owner(chatroom_name) != self.shard:
+                            cursor = fields[3] if len(fields) > 3 else ""
+                            self.hand_off(client_conn, self.owner(chatroom_name), commands, chatroom_name, cursor)
+                            return
+                # Receive message from client
+                data = client_conn.sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                commands.extend(client_conn.feed(data))
+            except Exception as e:
+                log.warning("Client connection failed: %s", e)
+                break
+
+        client_conn.close()
+        self.drop_connection(client_conn)
+        self.open_connections.dec()
+
+    def route(self, fields):
+        # The shard a command has to run on. A command whose chatroom or user
+        # is not text stays here, to be refused as malformed.
+        if not fields:
+            return self.shard
+        command = fields[0]
+        if command in ROOM_COMMANDS and len(fields) > 2 and isinstance(fields[2], str):
+            return self.owner(fields[2])
+        if command in MEMBER_COMMANDS and len(fields) > 1 and isinstance(fields[1], str):
+            chatroom_name = self.state.room_of(fields[1]) or self.coordinator.call("ROOM", fields[1])[0]
+            if chatroom_name:
+                return self.owner(chatroom_name)
+        return self.shard
+
+    def hand_off(self, client_conn, shard, commands, replay_room="", replay_cursor=""):
+        # Pass the socket and everything the connection still has to do to another shard
+        if client_conn.username is not None:
+            self.state.remove_connection(client_conn.username, client_conn)
+        client_sock = client_conn.detach()
+        leftover = bytes(client_conn.decoder.buffer) if client_conn.framed else b""
+        pending = [encode_frame(kind, fields, request_id) for kind, request_id, fields in commands]
+        compressed = int(client_conn.codec is not None)
+        try:
+            reply = self.peers[shard].call("HANDOFF", client_conn.username or "", int(client_conn.framed), compressed,
+                                           leftover, replay_room, str(replay_cursor), *pending,
+                                           fds=[client_sock.fileno()])[0]
+            if reply != "SUCCESS":
+                raise ConnectionError(f"Shard {shard} did not take the connection over: {reply}")
+        except OSError:
+            # Nobody serves the connection, let the client know
+            client_sock.shutdown(socket.SHUT_RDWR)
+            raise
+        finally:
+            # The other shard has its own descriptor for the socket
+            client_sock.close()
+        self.open_connections.dec()
+
+    def adopt(self, fd, username, framed, compressed, leftover, replay_room, replay_cursor, *pending):
+        # Take over a connection handed over by another shard
+        client_conn = SocketConnection(socket.socket(fileno=fd), self.max_queue, self.backpressure, self.queue_stats,
+                                       self.codec)
+        self.open_connections.inc()
+        try:
+            self.watch(client_conn)
+            client_conn.framed = bool(framed)
+            client_conn.codec = self.codec if compressed else None
+            client_conn.decoder = FrameDecoder(client_conn.codec) if framed else TextDecoder()
+            if framed:
+                client_conn.decoder.buffer += leftover
+            if username:
+                self.ensure_user(username)
+                self.state.add_connection(username, client_conn)
+                client_conn.username = username
+            if replay_room:
+                self.replay_history(client_conn, replay_room, replay_cursor)
+            commands = FrameDecoder().feed(b"".join(pending))
+        except Exception:
+            # Nothing is going to serve the connection
+            client_conn.close()
+            self.drop_connection(client_conn)
+            self.open_connections.dec()
+            raise
+        threading.Thread(target=self.serve_client, args=(client_conn, commands)).start()
+
+    def handle_control(self, fields, fds):
+        # Requests from the other shards
+        command = fields[0]
+        if command == "HANDOFF":
+            self.adopt(fds.pop(0), *fields[1:])
+            return ["SUCCESS"]
+        # Every chatroom of this shard, or the given ones
+        elif command == "ROOMS":
+            listing = ChatServer.room_members(self, fields[1:]) if len(fields) > 1 else ChatServer.room_listing(self)
+            return encode_listing(listing)
+        # A page of the chatrooms of this shard: version, whether more follow, chatrooms
+        elif command == "PAGE":
+            version, listing, more = ChatServer.directory_page(self, fields[1], fields[2], fields[3] or None)
+            return [version, int(more), *encode_listing(listing)]
+        # Chatrooms of this shard changed since a version: version, whether they are known, chatrooms
+        elif command == "CHANGES":
+            version, listing = self.state.directory.since_rooms(fields[1], fields[2])
+            if listing is None:
+                return [version, 0]
+            return [version, 1, *encode_listing(listing)]
+        # Send a direct message to the connections of a user on this shard
+        elif command == "DIRECT":
+            return [self.send_direct(PreparedEvent(fields[2:]), self.state.connections(fields[1]))]
+        # Post a message to chatrooms of this shard
+        elif command == "POST":
+            self.ensure_user(fields[1])
+            return [ChatServer.post_to_rooms(self, fields[1], fields[2], fields[3:])]
+        # A user moved to a chatroom of another shard
+        elif command == "LEAVE":
+            username, chatroom_name = fields[1], fields[2]
+            with self.state.user_lock(username):
+                if self.state.room_of(username) == chatroom_name:
+                    self.state._leave_room(username)
+            return ["SUCCESS"]
+        return [f"ERROR: Unknown command {command}"]
+
+    def ensure_user(self, username):
+        # Users registered on other shards are looked up once and remembered
+        if not self.state.is_registered(username):
+            credential = self.coordinator.call("LOOKUP", username)[0]
+            if credential:
+                self.state.add_user(username, credential)
+
+    def handle_command(self, client_conn, data, request_id=0):
+        if len(data) > 1 and data[0] not in ("REGISTER", "VIEW_CHATROOMS", "ROOM_MEMBERS"):
+            self.ensure_user(data[1])
+        super().handle_command(client_conn, data, request_id)
+
+    def register_user(self, username, password):
+        # Check if username already exists before paying for the hash
+        if self.state.is_registered(username) or self.coordinator.call("LOOKUP", username)[0]:
+            return "ERROR: Username already taken"
+
+        credential = self.hasher.hash(password)
+        message = self.coordinator.call("REGISTER", username, credential)[0]
+        if message == "SUCCESS":
+            self.state.add_user(username, credential)
+            log.info("Registered user %s and joined into the system", username)
+        return message
+
+    def login_user(self, username, password):
+        message = super().login_user(username, password)
+        # The user's chatroom may be on another shard
+        if message == "SUCCESS":
+            chatroom_name = self.coordinator.call("ROOM", username)[0]
+            if chatroom_name:
+                return f"SUCCESS|{chatroom_name}"
+        return message
+
+    def logout_user(self, username):
+        if not super().logout_user(username):
+            return False
+        old_room = self.coordinator.call("CLEAR", username)[0]
+        if old_room and self.owner(old_room) != self.shard:
+            self.peers[self.owner(old_room)].call("LEAVE", username, old_room)
+        return True
+
+    def create_chatroom(self, username, chatroom_name):
+        if not self.state.is_registered(username) or self.state.has_room(chatroom_name):
+            return super().create_chatroom(username, chatroom_name)
+        # The user may be in a chatroom of another shard
+        message = self.coordinator.call("CLAIM", username, chatroom_name)[0]
+        if message != "SUCCESS":
+            log.debug("Client %s already in another chatroom", username)
+            return message
+        message = super().create_chatroom(username, chatroom_name)
+        if message != "SUCCESS":
+            self.coordinator.call("CLEAR", username)
+        return message
+
+    def join_chatroom(self, username, chatroom_name):
+        if not self.state.is_registered(username) or not self.state.has_room(chatroom_name):
+            return super().join_chatroom(username, chatroom_name)
+        # Leave the old chatroom on the shard that owns it, a local one is left by the join
+        old_room = self.coordinator.call("MOVE", username, chatroom_name)[0]
+        if old_room and self.owner(old_room) != self.shard:
+            self.peers[self.owner(old_room)].call("LEAVE", username, old_room)
+            log.info("Client %s left chatroom %s", username, old_room)
+        return super().join_chatroom(username, chatroom_name)
+
+    def leave_chatroom(self, username):
+        message = super().leave_chatroom(username)
+        if message == "SUCCESS":
+            self.coordinator.call("CLEAR", username)
+        return message
+
+    def room_listing(self):
+        # Gather the chatrooms of every shard
+        listing = []
+        for shard, peer in enumerate(self.peers):
+            if shard == self.shard:
+                listing += super().room_listing()
+            else:
+                listing += parse_listing(peer.call("ROOMS"))
+        return sorted(listing)
+
+    def full_listing(self):
+        return format_rooms(self.room_listing())
+
+    def directory_page(self, prefix, after, limit):
+        # Every shard sends its first chatrooms after the cursor, the page is the
+        # first of all of them. The version has the version of every shard.
+        versions = []
+        listing = []
+        more = False
+        for shard, peer in enumerate(self.peers):
+            if shard == self.shard:
+                version, shard_listing, shard_more = super().directory_page(prefix, after, limit)
+            else:
+                version, shard_more, *fields = peer.call("PAGE", prefix, after, limit or 0)
+                shard_listing = parse_listing(fields)
+            versions.append(str(version))
+            listing += shard_listing
+            more = more or bool(shard_more)
+        listing.sort()
+        if limit is not None and len(listing) > limit:
+            listing = listing[:limit]
+            more = True
+        return ".".join(versions), listing, more
+
+    def directory_changes(self, since, prefix):
+        # The version has one part per shard, each shard is asked for its own changes
+        versions = since.split(".")
+        if len(versions) != self.shards or not all(version.isdigit() for version in versions):
+            return since, None
+        current = []
+        listing = []
+        for shard, peer in enumerate(self.peers):
+            if shard == self.shard:
+                shard_version, shard_listing = self.state.directory.since_rooms(int(versions[shard]), prefix)
+            else:
+                shard_version, shard_known, *fields = peer.call("CHANGES", int(versions[shard]), prefix)
+                shard_listing = parse_listing(fields) if shard_known else None
+            if shard_listing is None:
+                return since, None
+            current.append(str(shard_version))
+            listing += shard_listing
+        return ".".join(current), sorted(listing)
+
+    def rooms_by_shard(self, chatroom_names):
+        # Shard -> the given chatrooms it owns
+        shards = {}
+        for chatroom_name in dict.fromkeys(chatroom_names):
+            shards.setdefault(self.owner(chatroom_name), []).append(chatroom_name)
+        return shards
+
+    def room_members(self, chatroom_names):
+        listing = []
+        for shard, names in self.rooms_by_shard(chatroom_names).items():
+            if shard == self.shard:
+                listing += super().room_members(names)
+            else:
+                listing += parse_listing(self.peers[shard].call("ROOMS", *names))
+        return listing
+
+    def direct_message(self, username, recipient, message):
+        self.ensure_user(recipient)
+        return super().direct_message(username, recipient, message)
+
+    def deliver_direct(self, recipient, event):
+        # The recipient may have connections on any shard, their inbox is kept by the coordinator
+        sent = self.send_direct(event, self.state.connections(recipient))
+        for shard, peer in enumerate(self.peers):
+            if shard != self.shard:
+                sent += peer.call("DIRECT", recipient, *event.fields)[0]
+        if sent:
+            return sent
+        if self.coordinator.call("HOLD", recipient, self.inbox_size, *event.fields)[0] != "SUCCESS":
+            return None
+        return 0
+
+    def take_inbox(self, username):
+        fields = self.coordinator.call("INBOX", username)
+        return [PreparedEvent(fields[index:index + DIRECT_FIELDS]) for index in range(0, len(fields), DIRECT_FIELDS)]
+
+    def post_to_rooms(self, username, message, chatroom_names):
+        posted = 0
+        for shard, names in self.rooms_by_shard(chatroom_names).items():
+            if shard == self.shard:
+                posted += super().post_to_rooms(username, message, names)
+            else:
+                posted += self.peers[shard].call("POST", username, message, *names)[0]
+        return posted
+
+    def run_batch(self, client_conn, data, request_id):
+        # The commands of a batch may belong to different shards
+        client_conn.send_reply("ERROR: BATCH is not supported in sharded mode, pipeline the commands instead",
+                               request_id)
+
+    def current_info(self, username):
+        chatroom_name = self.coordinator.call("ROOM", username)[0]
+        if not chatroom_name:
+            return "ERROR: Client not in chatroom"
+        return f"SUCCESS|{chatroom_name}"
+
+
+def encode_listing(listing):
+    # Chatrooms for the ROOMS, PAGE and CHANGES requests: name, member count, members
+    fields = []
+    for chatroom_name, members in listing:
+        fields += [chatroom_name, len(members), *members]
+    return fields
+
+
+def parse_listing(fields):
+    # Chatrooms as made by encode_listing
+    listing = []
+    index = 0
+    while index < len(fields):
+        count = fields[index + 1]
+        listing.append((fields[index], fields[index + 2:index + 2 + count]))
+        index += 2 + count
+    return listing
+
+
+def exit_with_parent():
+    # A worker must not keep serving the port when the server process is gone
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(0)
+
+
+def run_shard(shard, shards, socket_dir, host, port, log_level, options):
+    # Entry point of a worker process
+    setup_logging(log_level)
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+    ShardWorker(shard, shards, socket_dir, host, port, **options).start()
+
+
+class ShardedChatServer:
+    # Runs the chat server as one worker process per shard, so the chatrooms
+    # are spread over all cores. This process runs the coordinator.
+    def __init__(self, host, port, workers=None, log_dir=None, metrics_port=None, log_level="INFO", state_dir=None,
+                 **options):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.log_dir = log_dir
+        self.state_dir = state_dir
+        self.metrics_port = metrics_port
+        self.log_level = log_level
+        self.options = options
+
+    def start(self):
+        socket_dir = tempfile.mkdtemp(prefix="chat-shards-")
+        # Clean up on kill too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            coordinator = Coordinator(coordinator_path(socket_dir),
+                                      os.path.join(self.state_dir, "coordinator") if self.state_dir else None,
+                                      self.options.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL))
+            coordinator.start()
+            # Fresh interpreters, the workers must not inherit the coordinator's threads
+            context = multiprocessing.get_context("spawn")
+            processes = []
+            for shard in range(self.workers):
+                options = dict(self.options)
+                # Every shard logs the messages of its own chatrooms
+                options["log_dir"] = os.path.join(self.log_dir, f"shard-{shard}") if self.log_dir else None
+                # keeps its own chatrooms and memberships
+                options["state_dir"] = os.path.join(self.state_dir, f"shard-{shard}") if self.state_dir else None
+                # and serves its own metrics
+                options["metrics_port"] = self.metrics_port + shard if self.metrics_port is not None else None
+                process = context.Process(target=run_shard, name=f"shard-{shard}",
+                                          args=(shard, self.workers, socket_dir, self.host, self.port,
+                                                self.log_level, options))
+                process.start()
+                processes.append(process)
+            log.info("Server started on %s:%s (%s shards)", self.host, self.port, self.workers)
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in multiprocessing.active_children():
+                process.terminate()
+            shutil.rmtree(socket_dir, ignore_errors=True)
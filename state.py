@@ -0,0 +1,237 @@
+import threading
+from collections import deque
+
+from directory import RoomDirectory
+
+# Number of locks the users are spread over
+USER_LOCK_STRIPES = 256
+# Direct messages kept for a user that has no connection
+DEFAULT_INBOX = 100
+
+
+class Room:
+    # A chatroom with its own lock, so work in one room never waits on another
+    __slots__ = ("name", "members", "lock", "last_seq")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.lock = threading.Lock()
+        # Sequence number of the last message, used when messages are not logged
+        self.last_seq = 0
+
+
+class ChatState:
+    # Keeps the users, chatrooms and connections of the server together with the
+    # indexes between them, so joins, leaves and logouts never scan other rooms.
+    #
+    # Safe to use from many threads. Every user maps to one of a fixed set of
+    # striped locks and every room has its own lock. A thread holds at most one
+    # user lock and one room lock at a time, always the user lock first, so the
+    # locks cannot deadlock. Connections of a user are stored as tuples that are
+    # replaced on change, so broadcasts read them without locking. Membership
+    # changes are reported to the room directory, whose lock is taken last, and
+    # a message is numbered and buffered under the lock of its room.
+    def __init__(self, stripes=USER_LOCK_STRIPES):
+        # Username -> stored credential (password hash) of every registered user
+        self.users = {}
+        # Users that are currently logged in
+        self.active_users = set()
+        # Chatroom name -> Room
+        self.rooms = {}
+        # Username -> name of the chatroom the user is in
+        self.user_room = {}
+        # Username -> tuple of connections of the user
+        self.user_conns = {}
+        # Username -> direct messages waiting for the user to connect, oldest first
+        self.inboxes = {}
+        self.user_locks = [threading.Lock() for _ in range(stripes)]
+        # Versioned listing of the chatrooms for VIEW_CHATROOMS
+        self.directory = RoomDirectory(self)
+        # Journal of the changes to users and memberships, when they are kept on disk
+        self.journal = None
+        # Cleared while the credentials of restored users are still being loaded
+        self.credentials_loaded = threading.Event()
+        self.credentials_loaded.set()
+
+    def user_lock(self, username):
+        return self.user_locks[hash(username) % len(self.user_locks)]
+
+    def is_registered(self, username):
+        return username in self.users
+
+    def credential(self, username):
+        credential = self.users.get(username)
+        if credential is None and not self.credentials_loaded.is_set():
+            self.credentials_loaded.wait()
+            credential = self.users.get(username)
+        return credential
+
+    def record(self, *fields):
+        # Only queues the change, so it is journaled in order under the user lock
+        if self.journal is not None:
+            self.journal.record(*fields)
+
+    def restore(self, users, user_room, rooms):
+        # Take over users, memberships and chatrooms loaded from disk, before serving.
+        # Restored users are logged out until they log in again.
+        self.users = users
+        self.user_room = user_room
+        self.rooms = {chatroom_name: Room(chatroom_name) for chatroom_name in rooms}
+        for username, chatroom_name in user_room.items():
+            self.rooms[chatroom_name].members.add(username)
+        self.directory.reset()
+
+    def capture(self):
+        # Copies of what is kept on disk, each copied in one go
+        self.credentials_loaded.wait()
+        return dict(self.users), dict(self.user_room), list(self.rooms)
+
+    def add_user(self, username, credential):
+        # Returns False if the username is already taken
+        with self.user_lock(username):
+            if username in self.users:
+                return False
+            self.users[username] = credential
+            self.active_users.add(username)
+            self.record("USER", username, credential)
+            return True
+
+    def activate(self, username):
+        self.active_users.add(username)
+
+    def deactivate(self, username):
+        # Log the user out and take them out of their chatroom
+        with self.user_lock(username):
+            self._leave_room(username)
+            self.active_users.discard(username)
+
+    def add_connection(self, username, conn):
+        with self.user_lock(username):
+            self.user_conns[username] = self.user_conns.get(username, ()) + (conn,)
+
+    def remove_connection(self, username, conn):
+        # Returns the number of connections the user still has, None if the
+        # connection was not one of them, such as when it was removed already
+        with self.user_lock(username):
+            conns = tuple(c for c in self.user_conns.get(username, ()) if c is not conn)
+            if len(conns) == len(self.user_conns.get(username, ())):
+                return None
+            if conns:
+                self.user_conns[username] = conns
+            else:
+                self.user_conns.pop(username, None)
+            return len(conns)
+
+    def connections(self, username):
+        return self.user_conns.get(username, ())
+
+    def connections_or_hold(self, username, event, limit=DEFAULT_INBOX):
+        # The connections to send a direct message to. When the user has none the
+        # message is put in their inbox instead and () is returned, or None when
+        # the inbox is full. Connecting takes the user lock too, so a message is
+        # never put in the inbox of a user that is just connecting.
+        with self.user_lock(username):
+            conns = self.user_conns.get(username, ())
+            if conns:
+                return conns
+            return () if self._hold(username, event, limit) else None
+
+    def hold(self, username, event, limit=DEFAULT_INBOX):
+        # Put a direct message in the inbox of a user, returns False if it is full
+        with self.user_lock(username):
+            return self._hold(username, event, limit)
+
+    def _hold(self, username, event, limit):
+        # Must be called with the user lock held
+        inbox = self.inboxes.setdefault(username, deque())
+        if len(inbox) >= limit:
+            return False
+        inbox.append(event)
+        return True
+
+    def take_inbox(self, username):
+        # The direct messages kept for a user, who gets them only once
+        with self.user_lock(username):
+            return list(self.inboxes.pop(username, ()))
+
+    def has_room(self, chatroom_name):
+        return chatroom_name in self.rooms
+
+    def room_of(self, username):
+        return self.user_room.get(username)
+
+    def members(self, chatroom_name):
+        # A snapshot of the members that stays valid while others join and leave
+        room = self.rooms.get(chatroom_name)
+        if room is None:
+            return ()
+        with room.lock:
+            return tuple(room.members)
+
+    def room_lock(self, chatroom_name):
+        return self.rooms[chatroom_name].lock
+
+    def next_seq(self, chatroom_name):
+        # Called with the room lock held
+        room = self.rooms[chatroom_name]
+        room.last_seq += 1
+        return room.last_seq
+
+    def room_listing(self):
+        # Snapshot of every chatroom and its members
+        return [(room.name, self.members(room.name)) for room in list(self.rooms.values())]
+
+    def create_room(self, username, chatroom_name):
+        # The creator is the first member. Returns False if the chatroom exists
+        # or the user is already in a chatroom.
+        with self.user_lock(username):
+            if username in self.user_room:
+                return False
+            room = Room(chatroom_name)
+            room.members.add(username)
+            # setdefault is atomic, only one of two concurrent creators wins
+            if self.rooms.setdefault(chatroom_name, room) is not room:
+                return False
+            self.user_room[username] = chatroom_name
+            self.directory.changed(chatroom_name)
+            self.record("JOIN", username, chatroom_name)
+            return True
+
+    def add_room(self, chatroom_name):
+        # A chatroom without members, such as one created on another server of
+        # the cluster. Returns False if it exists.
+        room = Room(chatroom_name)
+        if self.rooms.setdefault(chatroom_name, room) is not room:
+            return False
+        self.directory.changed(chatroom_name)
+        self.record("ROOM", chatroom_name)
+        return True
+
+    def join_room(self, username, chatroom_name):
+        # Returns the chatroom the user had to leave, if any
+        room = self.rooms[chatroom_name]
+        with self.user_lock(username):
+            old_room = self._leave_room(username)
+            with room.lock:
+                room.members.add(username)
+            self.user_room[username] = chatroom_name
+            self.directory.changed(chatroom_name)
+            self.record("JOIN", username, chatroom_name)
+            return old_room
+
+    def leave_room(self, username):
+        # Returns the chatroom the user left, if any
+        with self.user_lock(username):
+            return self._leave_room(username)
+
+    def _leave_room(self, username):
+        # Must be called with the user lock held
+        chatroom_name = self.user_room.pop(username, None)
+        if chatroom_name is not None:
+            room = self.rooms[chatroom_name]
+            with room.lock:
+                room.members.discard(username)
+            self.directory.changed(chatroom_name)
+            self.record("LEAVE", username)
+        return chatroom_name
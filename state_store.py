@@ -0,0 +1,303 @@
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+from itertools import accumulate
+
+from protocol import REQUEST, FrameDecoder, ProtocolError, encode_frame
+
+# Snapshot layout: header | sections, each a length and its bytes | crc32 of everything before it
+SNAPSHOT_MAGIC = b"CHTSNAP1"
+# Header layout: magic | number of the journal that follows the snapshot | users | chatrooms
+SNAPSHOT_HEADER = struct.Struct("!8sQQQ")
+SECTION = struct.Struct("!Q")
+CHECKSUM = struct.Struct("!I")
+# Chatroom index of a user that is in no chatroom
+NO_ROOM = -1
+
+# Seconds between snapshots, taken only when something changed
+DEFAULT_SNAPSHOT_INTERVAL = 300
+# How much of a journal is read at once when replaying it
+READ_SIZE = 1024 * 1024
+# Longest time a journaled change waits to be written
+FLUSH_INTERVAL = 0.05
+# Number of waiting changes that wakes the writer right away
+FLUSH_BATCH = 512
+
+log = logging.getLogger("chat.state_store")
+
+
+def snapshot_name(number):
+    return f"snapshot-{number:08d}.snap"
+
+
+def journal_name(number):
+    return f"journal-{number:08d}.log"
+
+
+def file_numbers(directory, prefix, suffix):
+    return sorted(int(name[len(prefix):-len(suffix)]) for name in os.listdir(directory)
+                  if name.startswith(prefix) and name.endswith(suffix))
+
+
+def pack_array(values):
+    # Arrays are stored big endian whatever the machine
+    if sys.byteorder == "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+
+def pack_strings(strings):
+    # Two sections: the length of every string, and all of them one after the other
+    encoded = [string.encode() for string in strings]
+    return [pack_array(array("I", map(len, encoded))), b"".join(encoded)]
+
+
+def unpack_strings(lengths, data):
+    lengths = unpack_array("I", lengths)
+    ends = accumulate(lengths)
+    data = bytes(data)
+    if data.isascii():
+        # Byte and character offsets are the same, decode everything at once
+        text = data.decode()
+        return [text[end - length:end] for end, length in zip(ends, lengths)]
+    return [data[end - length:end].decode() for end, length in zip(ends, lengths)]
+
+
+class StateStore:
+    # Keeps users, chatrooms and memberships on disk so a restart loses none of
+    # them. Every change is appended to a journal. Now and then the journal is
+    # switched for a new one and a snapshot of the state is written next to it,
+    # after which the older files are deleted. A restart loads the newest
+    # snapshot and replays the journals that follow it.
+    #
+    # Taking a snapshot only copies the dictionaries, which is quick, and writes
+    # the copies out on a background thread. The copies are made after the
+    # journal was switched and a change is journaled after it is made, so
+    # anything a snapshot misses is in a journal it is followed by. Replaying a
+    # change that a snapshot already has does no harm.
+    #
+    # Recording a change only queues its frame, without taking a lock, so the
+    # state may record changes while it holds its own locks and they reach the
+    # journal in the order they were made. A writer thread writes the queue out
+    # in batches, the way the message log syncs its appends.
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Protects the journal file
+        self.lock = threading.Lock()
+        self.journal = None
+        # Frames of changes waiting for the writer, oldest first
+        self.pending = deque()
+        self.wake = threading.Event()
+        # Number of the journal being appended to
+        self.number = 0
+        # Changes since the last snapshot
+        self.changes = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        # Restore the state and open a new journal. Returns users, the chatroom
+        # of each user, the chatrooms, and a function that fills in the
+        # credentials of the users, which are None until then. Decoding the
+        # credentials is the slowest part and no command needs them before a login.
+        users, user_room, rooms, start, fill = {}, {}, {}, 0, lambda users: None
+        for number in reversed(file_numbers(self.directory, "snapshot-", ".snap")):
+            try:
+                users, user_room, rooms, fill = self.read_snapshot(number)
+                start = number
+                break
+            except (OSError, ValueError, UnicodeDecodeError) as e:
+                log.warning("Skipping snapshot %s: %s", number, e)
+        journals = [number for number in file_numbers(self.directory, "journal-", ".log") if number >= start]
+        for number in journals:
+            self.changes += self.replay(number, users, user_room, rooms)
+        self.number = max([start] + journals) + 1
+        self.journal = open(self.path(journal_name(self.number)), "ab")
+        self.remove_older(start)
+        threading.Thread(target=self.write_loop, daemon=True).start()
+        return users, user_room, list(rooms), fill
+
+    def read_snapshot(self, number):
+        with open(self.path(snapshot_name(number)), "rb") as f:
+            data = f.read()
+        if len(data) < SNAPSHOT_HEADER.size + CHECKSUM.size:
+            raise ValueError("Snapshot is too short")
+        (checksum,) = CHECKSUM.unpack_from(data, len(data) - CHECKSUM.size)
+        if zlib.crc32(memoryview(data)[:-CHECKSUM.size]) != checksum:
+            raise ValueError("Snapshot checksum does not match")
+        magic, journal, user_count, room_count = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or journal != number:
+            raise ValueError("Not a snapshot of this store")
+        sections = []
+        offset = SNAPSHOT_HEADER.size
+        view = memoryview(data)
+        while offset < len(data) - CHECKSUM.size:
+            (length,) = SECTION.unpack_from(data, offset)
+            offset += SECTION.size
+            sections.append(view[offset:offset + length])
+            offset += length
+        room_lengths, room_data, user_lengths, user_data, user_rooms, credential_lengths, credential_data = sections
+
+        room_names = unpack_strings(room_lengths, room_data)
+        names = unpack_strings(user_lengths, user_data)
+        if len(room_names) != room_count or len(names) != user_count:
+            raise ValueError("Snapshot counts do not match")
+        users = dict.fromkeys(names)
+        user_room = {name: room_names[index]
+                     for name, index in zip(names, unpack_array("i", user_rooms)) if index != NO_ROOM}
+
+        def fill(users):
+            for name, credential in zip(names, unpack_strings(credential_lengths, credential_data)):
+                if users.get(name) is None:
+                    users[name] = credential
+
+        return users, user_room, dict.fromkeys(room_names), fill
+
+    def replay(self, number, users, user_room, rooms):
+        # Apply the changes of a journal, returns how many there were
+        decoder = FrameDecoder()
+        count = 0
+        with open(self.path(journal_name(number)), "rb") as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                try:
+                    frames = decoder.feed(data)
+                except ProtocolError as e:
+                    log.warning("Journal %s is damaged, replayed %s changes of it: %s", number, count, e)
+                    break
+                for kind, request_id, fields in frames:
+                    apply_change(fields, users, user_room, rooms)
+                    count += 1
+        # A change cut short by a crash is left out
+        return count
+
+    def record(self, *fields):
+        # Journal a change that has just been made
+        self.pending.append(encode_frame(REQUEST, list(fields)))
+        if len(self.pending) >= FLUSH_BATCH:
+            self.wake.set()
+
+    def write_loop(self):
+        while True:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            with self.lock:
+                try:
+                    self.write_pending()
+                except OSError as e:
+                    log.error("Journal write failed: %s", e)
+
+    def write_pending(self):
+        # Write out the waiting changes, called with the lock held. Only the
+        # holder of the lock takes from the queue.
+        frames = []
+        while self.pending:
+            frames.append(self.pending.popleft())
+        if frames:
+            self.journal.writelines(frames)
+            self.journal.flush()
+            self.changes += len(frames)
+
+    def snapshot(self, capture):
+        # capture() returns copies of the users, the chatroom of each user and the chatrooms
+        with self.lock:
+            # Changes recorded so far belong in the journal that is closed
+            self.write_pending()
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal.close()
+            self.number += 1
+            number = self.number
+            self.journal = open(self.path(journal_name(number)), "ab")
+            self.changes = 0
+        users, user_room, rooms = capture()
+        self.write_snapshot(number, users, user_room, rooms)
+        self.remove_older(number)
+        log.info("Wrote snapshot %s with %s users and %s chatrooms", number, len(users), len(rooms))
+
+    def write_snapshot(self, number, users, user_room, rooms):
+        rooms = list(dict.fromkeys([*rooms, *user_room.values()]))
+        room_index = {chatroom_name: index for index, chatroom_name in enumerate(rooms)}
+        names = list(users)
+        sections = [
+            *pack_strings(rooms),
+            *pack_strings(names),
+            pack_array(array("i", [room_index.get(user_room.get(name), NO_ROOM) for name in names])),
+            *pack_strings([users[name] for name in names]),
+        ]
+        data = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, number, len(names), len(rooms))]
+        for section in sections:
+            data += [SECTION.pack(len(section)), section]
+        checksum = 0
+        for part in data:
+            checksum = zlib.crc32(part, checksum)
+        # Written aside and renamed, a crash never leaves half a snapshot
+        path = self.path(snapshot_name(number))
+        with open(path + ".tmp", "wb") as f:
+            f.writelines(data)
+            f.write(CHECKSUM.pack(checksum))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def remove_older(self, number):
+        # Snapshots and journals that the snapshot of the given number makes unnecessary
+        for older in file_numbers(self.directory, "snapshot-", ".snap"):
+            if older < number:
+                os.remove(self.path(snapshot_name(older)))
+        for older in file_numbers(self.directory, "journal-", ".log"):
+            if older < number:
+                os.remove(self.path(journal_name(older)))
+
+    def run(self, capture, interval):
+        # Compact what was replayed at startup right away, then snapshot now and then
+        while True:
+            if self.changes or self.pending:
+                try:
+                    self.snapshot(capture)
+                except OSError as e:
+                    log.error("Snapshot failed: %s", e)
+            time.sleep(interval)
+
+    def start(self, capture, interval=DEFAULT_SNAPSHOT_INTERVAL):
+        threading.Thread(target=self.run, args=(capture, interval), daemon=True).start()
+
+    def close(self):
+        with self.lock:
+            self.write_pending()
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal.close()
+
+
+def apply_change(fields, users, user_room, rooms):
+    # Replay one journaled change
+    change = fields[0]
+    if change == "USER":
+        users[fields[1]] = fields[2]
+    elif change == "JOIN":
+        user_room[fields[1]] = fields[2]
+        rooms[fields[2]] = None
+    elif change == "LEAVE":
+        user_room.pop(fields[1], None)
+    elif change == "ROOM":
+        rooms[fields[1]] = None